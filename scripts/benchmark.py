@@ -0,0 +1,341 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import os
+import time
+
+# Add project root to path to allow importing from src
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import CACHE_DIR_NAME, LazyDataset, get_event_store, get_processed_data, load_dimensions
+from src.kpis import (RFM_MEASURES, RFM_SKETCH_EPS, calculate_channel_conversion, calculate_kpis_streaming, calculate_revenue_by_offer,
+                      calculate_rfm, calculate_rfm_segments, compute_all_kpis, compute_all_kpis_parallel, fit_rfm_model, refresh_rfm,
+                      rfm_from_state, rfm_state_sketches, score_rfm_partitions)
+from src.synthetic import write_dataset
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stage name -> function of the benchmark inputs (see _inputs)
+STAGES = {
+    'get_processed_data (csv)': lambda inp: get_processed_data(inp['data_dir'], use_cache=False),
+    'get_processed_data (cache)': lambda inp: get_processed_data(inp['data_dir'], use_cache=True),
+    'get_event_store (open)': lambda inp: get_event_store(inp['data_dir']).facts,
+    'calculate_rfm': lambda inp: calculate_rfm(inp['df']),
+    # Reads only the transaction rows and the three columns it uses
+    'calculate_rfm (lazy)': lambda inp: calculate_rfm(LazyDataset(inp['data_dir'])),
+    'calculate_channel_conversion': lambda inp: calculate_channel_conversion(inp['df'], inp['portfolio']),
+    'calculate_revenue_by_offer': lambda inp: calculate_revenue_by_offer(inp['df']),
+    'compute_all_kpis': lambda inp: compute_all_kpis(inp['df'], inp['portfolio']),
+}
+
+# Inputs of the running scale; forked children inherit them
+_INPUTS = {}
+
+def _max_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+def _measure(stage):
+    """Runs one stage on _INPUTS; returns its timings and memory use."""
+    start_rss = _max_rss_mb()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    out = STAGES[stage](_INPUTS)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    peak_rss = _max_rss_mb()
+    return {
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'peak_rss_mb': peak_rss,
+        'peak_delta_mb': peak_rss - start_rss,
+        'rows_out': len(out) if hasattr(out, '__len__') else 1,
+    }
+
+def _child(stage, conn):
+    try:
+        conn.send(_measure(stage))
+    except Exception as e:
+        conn.send({'error': repr(e)})
+    conn.close()
+
+def measure(stage):
+    """_measure in a forked child, so each stage's peak RSS is its own.
+
+    The child starts from the parent's memory (inputs included); peak_delta_mb
+    is what the stage adds on top. Without fork the stage runs in-process and
+    peak RSS only grows across stages.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return _measure(stage)
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(stage, child_conn))
+    proc.start()
+    result = parent_conn.recv()
+    proc.join()
+    if 'error' in result:
+        raise RuntimeError(f"Stage '{stage}' failed: {result['error']}")
+    return result
+
+def _inputs(data_dir):
+    # Builds the Parquet cache and the event store too, so their loads are measured warm
+    df = get_processed_data(data_dir, use_cache=True)
+    get_event_store(data_dir)
+    portfolio, _ = load_dimensions(data_dir)
+    return {'data_dir': data_dir, 'df': df, 'portfolio': portfolio.rename(columns={'id': 'id_oferta'})}
+
+def run_scale(scale, seed, stages, repeat=1):
+    """Benchmarks `stages` on a synthetic dataset `scale` times the sample size."""
+    data_dir = os.path.join(PROJECT_ROOT, 'data', CACHE_DIR_NAME, 'synthetic', f"x{scale:g}-seed{seed}") + os.sep
+    start = time.perf_counter()
+    write_dataset(data_dir, scale=scale, seed=seed, source_dir=os.path.join(PROJECT_ROOT, 'data'))
+    print(f"[x{scale:g}] dataset ready in {time.perf_counter() - start:.1f}s ({data_dir})")
+
+    _INPUTS.clear()
+    _INPUTS.update(_inputs(data_dir))
+    n_events = len(_INPUTS['df'])
+
+    rows = []
+    for stage in stages:
+        # Best wall time of `repeat` runs
+        result = min((measure(stage) for _ in range(repeat)), key=lambda r: r['wall_s'])
+        result.update({
+            'scale': scale,
+            'stage': stage,
+            'rows_in': n_events,
+            'rows_per_s': n_events / result['wall_s'] if result['wall_s'] else None,
+        })
+        rows.append(result)
+        print(f"[x{scale:g}] {stage}: {result['wall_s']:.3f}s, peak {result['peak_rss_mb']:.0f} MB (+{result['peak_delta_mb']:.0f}), {result['rows_per_s']:,.0f} rows/s")
+    _INPUTS.clear()
+    return rows
+
+def _synthetic_rfm_state(n_customers, seed=0):
+    # Integer customer ids (in id order), 30 days of purchases
+    rng = np.random.default_rng(seed)
+    frequency = 1 + rng.poisson(2.5, n_customers)
+    state = pd.DataFrame({
+        'last_time': rng.integers(0, 715, n_customers),
+        'Frequency': frequency,
+        'Monetary': np.round(rng.lognormal(2.5, 0.8, n_customers) * frequency, 2),
+    }, index=pd.RangeIndex(n_customers, name='cliente'))
+    return state
+
+def _edge_ranks(rfm, model):
+    # Rank interval of each model edge in the exact (value, cliente) order;
+    # a value edge without ids spans its whole run of tied values
+    ranks = {}
+    for measure in RFM_MEASURES:
+        values, ids = rfm[measure].to_numpy(), model.edge_ids.get(measure)
+        below = np.array([(values < edge).sum() for edge in model.edges[measure]])
+        if ids is None:
+            ranks[measure] = below + 1, np.array([(values <= edge).sum() for edge in model.edges[measure]])
+        else:
+            ties = np.array([((values == edge) & (rfm.index.to_numpy() <= edge_id)).sum() for edge, edge_id in zip(model.edges[measure], ids)])
+            ranks[measure] = below + ties, below + ties
+    return ranks
+
+def _rank_distance(a, b):
+    # Gap between rank intervals (0 when they overlap)
+    return np.maximum(0, np.maximum(a[0] - b[1], b[0] - a[1]))
+
+def rfm_sketch_run(n_customers, partitions=8, eps=RFM_SKETCH_EPS, seed=0):
+    """Exact qcut scoring vs partitions scored from merged quantile sketches.
+
+    'sketch_serial_s' scores the partitions one after the other,
+    'sketch_parallel_s' in a pool of one process per partition (pickling
+    included; only faster than serial with that many free cores).
+    """
+    state = _synthetic_rfm_state(n_customers, seed)
+    start = time.perf_counter()
+    exact = rfm_from_state(state)
+    exact_s = time.perf_counter() - start
+
+    parts = [state.iloc[i::partitions] for i in range(partitions)]
+    start = time.perf_counter()
+    model, scored = score_rfm_partitions(parts, eps)
+    serial_s = time.perf_counter() - start
+    start = time.perf_counter()
+    score_rfm_partitions(parts, eps, workers=partitions)
+    parallel_s = time.perf_counter() - start
+    scored = pd.concat(scored).sort_index()
+
+    exact_ranks = _edge_ranks(exact, fit_rfm_model(exact))
+    sketch_ranks = _edge_ranks(exact, model)
+    row = {
+        'customers': n_customers,
+        'partitions': partitions,
+        'cpu_count': os.cpu_count(),
+        'eps': eps,
+        'sketch_points': int(sum(len(rfm_state_sketches(part, eps)[m]) for part in parts for m in RFM_MEASURES)),
+        'exact_s': exact_s,
+        'sketch_serial_s': serial_s,
+        'sketch_parallel_s': parallel_s,
+        'max_rank_error': max(_rank_distance(sketch_ranks[m], exact_ranks[m]).max() for m in RFM_MEASURES) / n_customers,
+    }
+    row['speedup_serial'] = row['exact_s'] / row['sketch_serial_s']
+    row['speedup_parallel'] = row['exact_s'] / row['sketch_parallel_s']
+    for measure, column in (('R', 'R_Score'), ('F', 'F_Score'), ('M', 'M_Score')):
+        row[f'{measure}_agreement'] = float((scored[column].to_numpy() == exact[column].to_numpy()).mean())
+    print(f"[{n_customers:,} customers, eps={eps:g}] exact {exact_s:.2f}s, sketch {serial_s:.2f}s serial, "
+          f"{parallel_s:.2f}s on {partitions} processes ({os.cpu_count()} CPUs), max edge rank error {row['max_rank_error']:.2e}")
+    return row
+
+def rfm_sketch_main(customers, partitions=8, eps=(RFM_SKETCH_EPS,), seed=0, output=None):
+    rows = [rfm_sketch_run(n, partitions, e, seed) for n in customers for e in eps]
+    commit, dirty = _git_commit()
+    if output is None:
+        name = f"rfm-sketch-{commit or 'unknown'}{'-dirty' if dirty else ''}.json"
+        output = os.path.join(PROJECT_ROOT, 'reports', 'benchmarks', name)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'dirty': dirty, 'seed': seed, 'results': rows}, f, indent=2)
+    print(f"\nResults saved to {output}")
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(pd.DataFrame(rows).set_index(['customers', 'eps']).round(4))
+    return rows
+
+RFM_COLUMNS = ['Recency', 'Frequency', 'Monetary', 'R_Score', 'F_Score', 'M_Score', 'Segment']
+
+def _rfm_mismatches(rfm, exact):
+    # Customers whose value differs from the one-pass table, per column
+    rfm = rfm.set_axis(rfm.index.astype(str))
+    exact = exact.set_axis(exact.index.astype(str))
+    counts = {'customers': abs(len(rfm) - len(exact)) + int((~rfm.index.isin(exact.index)).sum())}
+    rfm = rfm.reindex(exact.index)
+    for column in RFM_COLUMNS:
+        counts[column] = int((rfm[column].to_numpy() != exact[column].to_numpy()).sum())
+    return counts
+
+def _refresh_in_pieces(data_dir, pieces):
+    # refresh_rfm on a copy of the data whose event log grows in `pieces` appends
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('portfolio_ofertas.csv', 'dados_clientes.csv'):
+            shutil.copy(os.path.join(data_dir, name), tmp)
+        with open(os.path.join(data_dir, 'eventos_ofertas.csv'), 'rb') as f:
+            header, *lines = f.readlines()
+        events_path = os.path.join(tmp, 'eventos_ofertas.csv')
+        with open(events_path, 'wb') as f:
+            f.write(header)
+        # Uneven cuts, so appends start inside a run of equal tempo_decorrido
+        cuts = np.unique(np.linspace(0, len(lines), pieces + 1).astype(int) + np.arange(pieces + 1) * 7)
+        for lo, hi in zip(cuts[:-1], np.append(cuts[1:-1], len(lines))):
+            with open(events_path, 'ab') as f:
+                f.writelines(lines[lo:hi])
+            rfm = refresh_rfm(tmp + os.sep)
+    return rfm
+
+def rfm_check_main(data_dir, chunksizes=(300, 5000, 20000), pieces=(2, 7)):
+    """Checks that the chunked, incremental and parallel RFM paths reproduce calculate_rfm_segments.
+
+    Counts, per path, the customers whose R/F/M value, score or Segment
+    differs from the one-pass table; returns True when all are zero.
+    """
+    exact = calculate_rfm_segments(get_processed_data(data_dir))
+    rows = {}
+    for chunksize in chunksizes:
+        rows[f'streaming chunksize={chunksize}'] = _rfm_mismatches(calculate_kpis_streaming(data_dir, chunksize=chunksize)['rfm'], exact)
+    for n in pieces:
+        rows[f'refresh_rfm {n} appends'] = _rfm_mismatches(_refresh_in_pieces(data_dir, n), exact)
+    portfolio, _ = load_dimensions(data_dir)
+    parallel = compute_all_kpis_parallel(get_processed_data(data_dir), portfolio.rename(columns={'id': 'id_oferta'}), workers=2, metrics=('rfm',))
+    rows['parallel workers=2'] = _rfm_mismatches(parallel['rfm'], exact)
+
+    table = pd.DataFrame(rows).T
+    print(f"Customers differing from calculate_rfm_segments ({len(exact):,} customers):")
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(table)
+    return not table.to_numpy().any()
+
+def _git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def compare(results, baseline_path):
+    """Wall time of `results` relative to a saved run (ratio < 1 is faster)."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    key = ['scale', 'stage']
+    new = pd.DataFrame(results['results']).set_index(key)
+    old = pd.DataFrame(baseline['results']).set_index(key)
+    table = pd.DataFrame({
+        'wall_s_before': old['wall_s'],
+        'wall_s_after': new['wall_s'],
+        'peak_rss_mb_before': old['peak_rss_mb'],
+        'peak_rss_mb_after': new['peak_rss_mb'],
+    }).dropna()
+    table['wall_ratio'] = table['wall_s_after'] / table['wall_s_before']
+    return table
+
+def main(scales=(1, 10, 100), seed=0, stages=None, repeat=1, output=None, baseline=None):
+    stages = list(stages or STAGES)
+    rows = []
+    for scale in scales:
+        rows.extend(run_scale(scale, seed, stages, repeat))
+
+    commit, dirty = _git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': rows,
+    }
+
+    if output is None:
+        name = f"{commit or 'unknown'}{'-dirty' if dirty else ''}.json"
+        output = os.path.join(PROJECT_ROOT, 'reports', 'benchmarks', name)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    table = pd.DataFrame(rows).set_index(['scale', 'stage'])
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(table[['wall_s', 'cpu_s', 'peak_rss_mb', 'peak_delta_mb', 'rows_per_s']].round(3))
+        if baseline:
+            print(f"\nCompared with {baseline}:")
+            print(compare(results, baseline).round(3))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data scaled from the sample files.")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100], help="Dataset sizes as multiples of the sample (default: 1 10 100).")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic data generator.")
+    parser.add_argument('--stage', action='append', choices=list(STAGES), help="Benchmark only this stage (repeatable).")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per stage; the fastest is reported.")
+    parser.add_argument('--output', help="JSON results path (default: reports/benchmarks/<commit>.json).")
+    parser.add_argument('--compare', metavar='JSON', help="Print wall-time ratios against a saved results file.")
+    parser.add_argument('--rfm-sketch', type=int, nargs='+', metavar='CUSTOMERS', help="Instead of the stages: compare exact RFM quintiles with quantile sketches at these customer counts.")
+    parser.add_argument('--partitions', type=int, default=8, help="Customer partitions for --rfm-sketch.")
+    parser.add_argument('--eps', type=float, nargs='+', default=[RFM_SKETCH_EPS], help="Sketch rank-error bounds for --rfm-sketch.")
+    parser.add_argument('--check-rfm', action='store_true', help="Instead of the stages: check that the streaming, incremental and parallel RFM tables equal the one-pass one on data/; exits 1 on a difference.")
+    args = parser.parse_args()
+    if args.check_rfm:
+        sys.exit(0 if rfm_check_main(os.path.join(PROJECT_ROOT, 'data') + os.sep) else 1)
+    if args.rfm_sketch:
+        rfm_sketch_main(args.rfm_sketch, partitions=args.partitions, eps=args.eps, seed=args.seed, output=args.output)
+        sys.exit()
+    main(scales=args.scales, seed=args.seed, stages=args.stage, repeat=args.repeat, output=args.output, baseline=args.compare)
@@ -1,87 +1,238 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import glob
+import json
 import sys
 import os
 
 # Add project root to path to allow importing from src
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from src.data_loader import get_processed_data, load_data
-from src.kpis import calculate_ticket_average, calculate_channel_conversion, calculate_revenue_by_offer, calculate_rfm, segment_customer
-from src.visualization import plot_demographics, plot_funnel, plot_rfm
+from src import instrumentation
+from src.data_loader import CACHE_DIR_NAME, REFERENCE_DATE, build_star_schema, clean_data, load_data, merge_data
+from src.kpis import (LIFECYCLE_TABLES, PLOT_TABLES, RFM_SCENARIOS, compare_rfm_scenarios, compute_all_kpis, compute_all_kpis_parallel,
+                      fit_rfm_model, rfm_base, rfm_reference_time, rfm_scenario_attributions, save_rfm_model)
+from src.pipeline import Pipeline
+from src.visualization import FIGURE_FILES, RFM_SCATTER_MAX_POINTS, render_plot
 
-def run():
+# Plot stages: figure name and the KPI-stage table it is drawn from
+PLOT_STAGES = {
+    'plot_demographics': ('demographics', 'demographics'),
+    'plot_funnel': ('funnel', 'funnel_counts'),
+    'plot_channels': ('channel_performance', 'channel_counts'),
+}
+
+# --- Stages ---
+# Each stage receives the outputs of its inputs, then its params/options.
+
+def load_stage(data_dir):
+    p_path = os.path.join(data_dir, 'portfolio_ofertas.csv')
+    e_path = os.path.join(data_dir, 'eventos_ofertas.csv')
+    pr_path = os.path.join(data_dir, 'dados_clientes.csv')
+    return load_data(p_path, e_path, pr_path)
+
+def clean_stage(raw, reference_date):
+    return clean_data(*raw, reference_date=reference_date)
+
+def merge_stage(cleaned, star):
+    # star=True keeps profile/portfolio as dimension tables (StarSchema)
+    portfolio, events, profile = cleaned
+    if star:
+        return build_star_schema(portfolio, events, profile)
+    return merge_data(portfolio, events, profile)
+
+def _compute(merged, portfolio, workers, metrics):
+    if workers > 1:
+        return compute_all_kpis_parallel(merged, portfolio, workers=workers, metrics=metrics)
+    return compute_all_kpis(merged, portfolio, metrics=metrics)
+
+def portfolio_stage(cleaned):
+    return cleaned[0].rename(columns={'id': 'id_oferta'})
+
+def kpis_stage(merged, portfolio, workers):
+    # The plot and lifecycle tables come out of the same pass over the events
+    return _compute(merged, portfolio, workers, ('ticket_average', 'channel_conversion', 'revenue_by_offer', 'weekly_kpis') + PLOT_TABLES + LIFECYCLE_TABLES)
+
+def rfm_stage(merged, workers):
+    return _compute(merged, None, workers, ('rfm',))['rfm']
+
+def rfm_model_stage(merged, rfm_df, model_path):
+    # Quintile edges + rules, for scoring new customers without the full data;
+    # the reference time lets the saved model measure their Recency itself
+    model = fit_rfm_model(rfm_df, reference_time=rfm_reference_time(merged))
+    save_rfm_model(model, model_path)
+    return model
+
+def rfm_base_stage(merged, scenarios):
+    # R/F/M aggregates (plus each attribution's Monetary) computed once for all scenarios
+    return rfm_base(merged, rfm_scenario_attributions(scenarios))
+
+def rfm_scenarios_stage(base, scenarios):
+    return compare_rfm_scenarios(base, scenarios)
+
+def load_scenarios(path):
+    """Scenario definitions from a JSON file; 'default' is the built-in RFM_SCENARIOS."""
+    if path == 'default':
+        return RFM_SCENARIOS
+    with open(path) as f:
+        return json.load(f)
+
+def plot_table_stage(kpis, plot, table, save_dir):
+    return render_plot(plot, kpis[table], save_dir=save_dir)
+
+def plot_rfm_stage(rfm_df, save_dir, rfm_plot, rfm_max_points):
+    return render_plot('rfm', rfm_df, save_dir=save_dir, mode=rfm_plot, max_points=rfm_max_points)
+
+def build_pipeline(project_root, star=False, workers=1, rfm_plot='auto', rfm_max_points=RFM_SCATTER_MAX_POINTS, reference_date=REFERENCE_DATE, scenarios=None):
+    """Declares the pipeline stages and their inputs."""
+    data_dir = os.path.join(project_root, 'data')
+    params = {
+        'data_dir': data_dir,
+        'save_dir': os.path.join(project_root, 'reports', 'figures'),
+        'star': star,
+        'reference_date': reference_date,
+        'workers': workers,
+        'rfm_plot': rfm_plot,
+        'rfm_max_points': rfm_max_points,
+        'scenarios': scenarios,
+        'model_path': os.path.join(data_dir, CACHE_DIR_NAME, 'rfm_model.json'),
+    }
+    sources = [os.path.join(data_dir, name) for name in ('portfolio_ofertas.csv', 'eventos_ofertas.csv', 'dados_clientes.csv')]
+    code_files = glob.glob(os.path.join(project_root, 'src', '*.py'))
+
+    pipeline = Pipeline(os.path.join(data_dir, CACHE_DIR_NAME, 'checkpoints'), params, code_files)
+    # load reads through the Parquet cache, which is its checkpoint already
+    pipeline.add('load', load_stage, params=['data_dir'], sources=sources, checkpoint=False)
+    pipeline.add('clean', clean_stage, inputs=['load'], params=['reference_date'])
+    pipeline.add('merge', merge_stage, inputs=['clean'], params=['star'])
+    pipeline.add('portfolio', portfolio_stage, inputs=['clean'])
+    pipeline.add('kpis', kpis_stage, inputs=['merge', 'portfolio'], options=['workers'])
+    pipeline.add('rfm', rfm_stage, inputs=['merge'], options=['workers'])
+    pipeline.add('rfm_model', rfm_model_stage, inputs=['merge', 'rfm'], params=['model_path'], outputs=[params['model_path']])
+    if scenarios:
+        pipeline.add('rfm_base', rfm_base_stage, inputs=['merge'], params=['scenarios'])
+        pipeline.add('rfm_scenarios', rfm_scenarios_stage, inputs=['rfm_base'], params=['scenarios'])
+    for name, (plot, table) in PLOT_STAGES.items():
+        stage = functools.partial(plot_table_stage, plot=plot, table=table)
+        pipeline.add(name, stage, inputs=['kpis'], params=['save_dir'], outputs=[os.path.join(params['save_dir'], FIGURE_FILES[plot])])
+    pipeline.add('plot_rfm', plot_rfm_stage, inputs=['rfm'], params=['save_dir', 'rfm_plot', 'rfm_max_points'],
+                 outputs=[os.path.join(params['save_dir'], FIGURE_FILES['rfm'])])
+    return pipeline
+
+def run(star=False, workers=1, force=(), rfm_plot='auto', rfm_max_points=RFM_SCATTER_MAX_POINTS, profile=None, reference_date=REFERENCE_DATE, scenarios=None):
     print("--- Starting Pipeline ---")
+    if profile:
+        # Through the environment too, so spawned worker processes profile as well
+        os.environ[instrumentation.ENV_VAR] = profile
+        instrumentation.enable()
     
     # Project Root and Data Directory
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    data_dir = os.path.join(project_root, 'data') + os.sep
+    pipeline = build_pipeline(project_root, star=star, workers=workers, rfm_plot=rfm_plot, rfm_max_points=rfm_max_points, reference_date=reference_date, scenarios=scenarios)
+    force = set(pipeline.stages) if 'all' in force else set(force)
 
     
     # 1. Load & Clean
     print("Step 1-3: Loading, Cleaning, and Merging Data...")
     try:
-        final_df = get_processed_data(data_dir=data_dir)
-        print(f"Data ready. Shape: {final_df.shape}")
+        if 'merge' not in force and pipeline.is_current('merge'):
+            # Only loaded later if a downstream stage has to run
+            print("Data up to date (checkpoint).")
+        else:
+            final_df = pipeline.value('merge', force)
+            print(f"Data ready. Shape: {final_df.shape}")
     except Exception as e:
         print(f"Error in data processing: {e}")
         return
 
-    # 2. KPIs
-    print("\nStep 4: Calculating KPIs...")
-    # Need portfolio for channel analysis
-    # Re-load portfolio raw for channel conversion logic (or pass it through)
-    # Ideally get_processed_data should return raw portfolio too if needed, but we can just reload it or modify src.
-    # For now, let's reload just for the KPI function requirements.
-    p_path = os.path.join(data_dir, 'portfolio_ofertas.csv')
-    e_path = os.path.join(data_dir, 'eventos_ofertas.csv')
-    pr_path = os.path.join(data_dir, 'dados_clientes.csv')
-    
-    portfolio, _, _ = load_data(p_path, e_path, pr_path)
-    portfolio = portfolio.rename(columns={'id': 'id_oferta'})
+    # Plots are drawn from small tables and render in the background,
+    # the KPI ones while the RFM model is computed
+    with ProcessPoolExecutor(max_workers=len(PLOT_STAGES) + 1) as pool:
+        plots = {}
 
-    ticket = calculate_ticket_average(final_df)
-    print(f"Ticket Average: {ticket:.2f}")
-    
-    conversion = calculate_channel_conversion(final_df, portfolio)
-    print("Channel Conversion:")
-    print(conversion)
-    
-    revenue = calculate_revenue_by_offer(final_df)
-    print("Revenue by Offer:")
-    print(revenue)
-    
-    # 3. RFM
-    print("\nStep 5: Segmentation (RFM)...")
-    rfm_df = calculate_rfm(final_df)
-    rfm_df['Segment'] = rfm_df.apply(segment_customer, axis=1)
-    print("Segments Distribution:")
-    print(rfm_df['Segment'].value_counts())
-    
-    # 4. Visualization
-    print("\nStep 6: Generating Visualizations...")
-    save_dir = os.path.join(project_root, 'reports', 'figures')
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+        # 2. KPIs
+        print("\nStep 4: Calculating KPIs...")
+        try:
+            kpis = pipeline.value('kpis', force)
+        except Exception as e:
+            print(f"Error calculating KPIs: {e}")
+            return
+        for name in PLOT_STAGES:
+            plots[name] = pipeline.submit(name, pool, force)
+
+        ticket = kpis['ticket_average']
+        print(f"Ticket Average: {ticket:.2f}")
+        print("Weekly KPIs:")
+        print(kpis['weekly_kpis'][['transactions', 'revenue', 'ticket_average', 'conversion_rate']])
         
-    print(f"Saving plots to {save_dir}...")
-    # Note: These functions call plt.show(), might block if interactive.
-    # We should adjust src to not show if saving, or just let it run.
-    # For a script, we usually want save only.
-    # But current src has show().
-    try:
-        import matplotlib.pyplot as plt
-        plt.ioff() # Turn off interactive mode to avoid blocking
-        plot_demographics(final_df, save_path=save_dir)
-        plot_funnel(final_df, save_path=save_dir)
-        plot_rfm(rfm_df, save_path=save_dir)
+        conversion = kpis['channel_conversion']
+        print("Channel Conversion:")
+        print(conversion)
         
-        from src.visualization import plot_channel_performance
-        plot_channel_performance(final_df, portfolio, save_path=save_dir)
+        revenue = kpis['revenue_by_offer']
+        print("Revenue by Offer:")
+        print(revenue)
+
+        print("Offer Lifecycle (received -> viewed -> completed):")
+        print(kpis['offer_lifecycle'][['oferta', 'received', 'view_rate', 'completion_rate', 'mean_time_to_complete']])
         
-        print("Visualizations saved.")
-    except Exception as e:
-        print(f"Error visualizing: {e}")
+        # 3. RFM
+        print("\nStep 5: Segmentation (RFM)...")
+        try:
+            rfm_df = pipeline.value('rfm', force)
+        except Exception as e:
+            print(f"Error in segmentation: {e}")
+            return
+        print("Segments Distribution:")
+        print(rfm_df['Segment'].value_counts())
+        plots['plot_rfm'] = pipeline.submit('plot_rfm', pool, force)
+        pipeline.value('rfm_model', force)
+        if pipeline.missing_outputs('rfm_model'):
+            print(f"Error: RFM model not written to {pipeline.params['model_path']}")
+        else:
+            print(f"RFM model saved to {pipeline.params['model_path']}")
+
+        if scenarios:
+            print("\nScenario comparison (one RFM base, scored per scenario):")
+            try:
+                print(pipeline.value('rfm_scenarios', force).round(3).to_string())
+            except Exception as e:
+                print(f"Error comparing scenarios: {e}")
+        
+        # 4. Visualization
+        print("\nStep 6: Generating Visualizations...")
+        print(f"Saving plots to {pipeline.params['save_dir']}...")
+        failed = False
+        for name, future in plots.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error visualizing ({name}): {e}")
+                failed = True
+                continue
+            for path in pipeline.missing_outputs(name):
+                print(f"Error visualizing ({name}): {path} not written")
+                failed = True
+        if not failed:
+            print("Visualizations saved.")
 
+    print("\nStages:", ", ".join(f"{name}={status}" for name, status in pipeline.status.items()))
+    if profile:
+        instrumentation.write_report(profile)
+        print(f"\nProfile saved to {profile}. Slowest calls:")
+        print(instrumentation.summary().head(10).round(3).to_string())
     print("\n--- Pipeline Completed Successfully ---")
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Run the customer segmentation pipeline.")
+    parser.add_argument('--star', action='store_true', help="Keep events as a fact table with offer/customer dimensions instead of one wide merged frame.")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for the KPI step (events hash-partitioned by customer).")
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE', help="Rerun a stage even if its checkpoint is current (repeatable; 'all' for every stage).")
+    parser.add_argument('--rfm-plot', choices=['auto', 'scatter', 'density', 'sample'], default='auto', help="RFM chart style; 'auto' switches from a scatter to per-segment density above --rfm-max-points customers.")
+    parser.add_argument('--rfm-max-points', type=int, default=RFM_SCATTER_MAX_POINTS, help="Customer count above which the RFM chart stops drawing one marker per customer.")
+    parser.add_argument('--reference-date', default=REFERENCE_DATE, help=f"Analysis date customer tenure (anos_de_membro) is measured at (default: {REFERENCE_DATE}).")
+    parser.add_argument('--scenarios', nargs='?', const='default', metavar='FILE', help="Also compare segmentation scenarios (score bins, segment rules, revenue attribution) from a JSON file, or the built-in ones without FILE.")
+    parser.add_argument('--profile', metavar='REPORT', default=os.environ.get(instrumentation.ENV_VAR) or None, help=f"Record time, CPU, memory and rows of every library call and stage; writes REPORT (.json or .csv). Also enabled by {instrumentation.ENV_VAR}=REPORT.")
+    args = parser.parse_args()
+    run(star=args.star, workers=args.workers, force=args.force, rfm_plot=args.rfm_plot, rfm_max_points=args.rfm_max_points, profile=args.profile, reference_date=args.reference_date, scenarios=load_scenarios(args.scenarios) if args.scenarios else None)
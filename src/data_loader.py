@@ -1,44 +1,874 @@
+import hashlib
+import io
+import json
+import operator
+import os
+import shutil
+import weakref
+
 import pandas as pd
 import numpy as np
+from pandas.api.types import union_categoricals
+
+from src.instrumentation import instrument
+
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+CACHE_DIR_NAME = '.cache'
+MANIFEST_NAME = 'manifest.json'
+
+# Analysis date anos_de_membro is measured at: the end of the year of the
+# latest sign-ups in the data, fixed so cleaned data is the same every run
+REFERENCE_DATE = '2018-12-31'
+
+# Read-time schema. Repeated strings are categoricals (integer codes plus one
+# copy of each label) and integers are downcast. Money (valor) stays float64
+# so revenue and RFM sums are bit-identical to the untyped frame.
+PORTFOLIO_SCHEMA = {
+    'id': 'category',
+    'oferta': 'category',
+    'canal': 'category',
+    'recompensa': 'int16',
+    'valor_minimo': 'int16',
+    'duracao': 'int16',
+}
+EVENTS_SCHEMA = {
+    'cliente': 'category',
+    'id_oferta': 'category',
+    'tipo_evento': 'category',
+    'tempo_decorrido': 'int32',
+    'valor': 'float64',
+    'recompensa': 'float32',
+}
+PROFILE_SCHEMA = {
+    'id': 'category',
+    'genero': 'category',
+    'idade': 'int16',
+    'membro_desde': 'int32',
+    'renda_anual': 'float32',
+}
+
+def _file_hash(path, chunk_size=1 << 20):
+    """Content hash (sha1) of a source file, read in 1 MiB blocks."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _read_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_manifest(cache_dir, manifest):
+    manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def file_sha1(path, cache_dir):
+    """Content hash of a file, remembered in `cache_dir`'s manifest.
+
+    Rehashed only when the file's size or mtime changed since it was last
+    hashed, the same short-circuit as the Parquet cache.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    manifest = _read_manifest(cache_dir)
+    key = f"sha1:{path}"
+    entry = manifest.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['sha1']
+    sha1 = _file_hash(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': sha1}
+    _write_manifest(cache_dir, manifest)
+    return sha1
+
+_FILTER_OPS = {
+    '==': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'in': lambda values, items: values.isin(items),
+    'not in': lambda values, items: ~values.isin(items),
+}
+
+@instrument
+def apply_filters(df, filters):
+    """Rows of df matching every (column, op, value) filter, pyarrow-style."""
+    if not filters:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        mask &= np.asarray(_FILTER_OPS[op](df[column], value), dtype=bool)
+    return df[mask].reset_index(drop=True)
+
+def _cached_frame(path, cache_dir, options, build, columns=None, filters=None):
+    """build() (a frame derived from the file at `path`) through a Parquet cache.
+
+    Entries are keyed on `options` and the file's size, mtime and content
+    hash. The cheap (size, mtime) check runs first; the content hash is only
+    recomputed when it fails, so a touched-but-unchanged file keeps its cache.
+    columns/filters are pushed into the Parquet read; on a cache miss the
+    full frame is cached first and then narrowed.
+    """
+    path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Different options (dtypes, cleaning) get separate cache entries
+    options = json.dumps(options, sort_keys=True, default=str)
+    name = os.path.splitext(os.path.basename(path))[0]
+    name = f"{name}-{hashlib.sha1(options.encode()).hexdigest()[:10]}"
+    cache_path = os.path.join(cache_dir, f"{name}.parquet")
+    stat = os.stat(path)
+    manifest = _read_manifest(cache_dir)
+    entry = manifest.get(name)
 
-def load_data(portfolio_path, events_path, profile_path):
-    """Loads raw data from CSVs."""
-    portfolio = pd.read_csv(portfolio_path, encoding='latin-1')
-    events = pd.read_csv(events_path, encoding='latin-1')
-    profile = pd.read_csv(profile_path, encoding='latin-1')
+    if entry and os.path.exists(cache_path):
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return pd.read_parquet(cache_path, columns=columns, filters=filters or None)
+        if entry['size'] == stat.st_size and entry['sha1'] == _file_hash(path):
+            entry['mtime'] = stat.st_mtime_ns
+            _write_manifest(cache_dir, manifest)
+            return pd.read_parquet(cache_path, columns=columns, filters=filters or None)
+
+    # Cache miss or stale source: rebuild
+    df = build()
+    df.to_parquet(cache_path, index=False)
+    manifest[name] = {
+        'source': path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha1': _file_hash(path),
+    }
+    _write_manifest(cache_dir, manifest)
+    if columns is not None or filters:
+        df = apply_filters(df if columns is None else df[columns], filters)
+    return df
+
+@instrument
+def read_csv_cached(path, cache_dir=None, columns=None, filters=None, **read_kwargs):
+    """Reads a latin-1 CSV through a Parquet cache keyed on size, mtime and content hash.
+
+    columns/filters (pyarrow-style (column, op, value) tuples, all ANDed)
+    are pushed into the Parquet read (see _cached_frame). Without pyarrow
+    this is a plain pd.read_csv (with usecols) followed by the filters.
+    """
+    read_kwargs.setdefault('encoding', 'latin-1')
+    if not HAS_PYARROW:
+        return apply_filters(pd.read_csv(path, usecols=columns, **read_kwargs), filters)
+    # The read options (dtypes) are part of the key: typed and untyped reads
+    # of the same file get separate cache entries
+    return _cached_frame(path, cache_dir, read_kwargs, lambda: pd.read_csv(path, **read_kwargs), columns, filters)
+
+def _drop_index_columns(df):
+    """Drops the unnamed row-number column the CSV exports carry."""
+    return df.drop(columns=[c for c in df.columns if c.startswith('Unnamed')])
+
+@instrument
+def load_data(portfolio_path, events_path, profile_path, use_cache=True, cache_dir=None, compact=True):
+    """Loads raw data from CSVs (through the columnar cache when use_cache is set).
+
+    With compact=True the *_SCHEMA dtypes are applied by read_csv itself and
+    the unnamed row-number columns are dropped.
+    """
+    if use_cache:
+        read = lambda path, **kw: read_csv_cached(path, cache_dir, **kw)
+    else:
+        read = lambda path, **kw: pd.read_csv(path, encoding='latin-1', **kw)
+
+    if not compact:
+        return read(portfolio_path), read(events_path), read(profile_path)
+
+    portfolio = _drop_index_columns(read(portfolio_path, dtype=PORTFOLIO_SCHEMA))
+    events = _drop_index_columns(read(events_path, dtype=EVENTS_SCHEMA))
+    profile = _drop_index_columns(read(profile_path, dtype=PROFILE_SCHEMA))
     return portfolio, events, profile
 
-def clean_data(portfolio, events, profile):
-    """Cleans and preprocesses data (Steps 1-2)."""
-    # Profile
-    profile['membro_desde'] = pd.to_datetime(profile['membro_desde'], format='%Y%m%d')
+def _concat_chunks(head, tail):
+    """Concatenates two event chunks, keeping categorical columns categorical."""
+    out = pd.concat([head, tail])
+    for col in head.columns:
+        if isinstance(head[col].dtype, pd.CategoricalDtype) and isinstance(tail[col].dtype, pd.CategoricalDtype):
+            out[col] = union_categoricals([head[col], tail[col]], ignore_order=True)
+    return out
+
+@instrument
+def iter_event_chunks(events_path, chunksize=250_000, compact=True):
+    """Yields the event log in chunks of about `chunksize` rows.
+
+    A chunk never splits a tempo_decorrido value: rows sharing the last
+    timestamp of a chunk are held back and prepended to the next one, so
+    same-timestamp joins see all their rows. The log must be ordered by
+    tempo_decorrido, as the source export is.
+    """
+    dtype = EVENTS_SCHEMA if compact else None
+    reader = pd.read_csv(events_path, encoding='latin-1', dtype=dtype, chunksize=chunksize)
+
+    carry = None
+    for chunk in reader:
+        if compact:
+            chunk = _drop_index_columns(chunk)
+        if carry is not None:
+            chunk = _concat_chunks(carry, chunk)
+        if not chunk['tempo_decorrido'].is_monotonic_increasing:
+            raise ValueError("Streaming ingestion needs the event log sorted by tempo_decorrido.")
+
+        times = chunk['tempo_decorrido'].to_numpy()
+        cut = np.searchsorted(times, times[-1], side='left')
+        carry = chunk.iloc[cut:]
+        if cut:
+            yield chunk.iloc[:cut]
+
+    if carry is not None and len(carry):
+        yield carry
+
+@instrument
+def read_events_since(events_path, offset=0, compact=True):
+    """Reads only the event rows stored after byte `offset` of the CSV.
+
+    Returns the events and the offset to resume from next time. Only whole
+    lines are consumed, so a partially written last row is picked up on the
+    next call. offset=0 reads the whole file.
+    """
+    with open(events_path, 'rb') as f:
+        header = f.readline()
+        f.seek(max(offset, len(header)))
+        body = f.read()
+    end = body.rfind(b'\n') + 1
+    start = max(offset, len(header))
+
+    dtype = EVENTS_SCHEMA if compact else None
+    events = pd.read_csv(io.BytesIO(header + body[:end]), encoding='latin-1', dtype=dtype)
+    if compact:
+        events = _drop_index_columns(events)
+    return events, start + end
+
+PREFIX_BLOCK = 1 << 16
+
+def prefix_digest(path, offset, block=PREFIX_BLOCK):
+    """sha1 of the first and last `block` bytes before `offset` of a file.
+
+    Stored with a read offset, it tells an appended log (same prefix) from
+    a rewritten one, even when the rewrite is larger.
+    """
+    digest = hashlib.sha1(str(offset).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(block, offset)))
+        f.seek(max(offset - block, 0))
+        digest.update(f.read(offset - f.tell()))
+    return digest.hexdigest()
+
+def _read_table(path, schema, use_cache=True, compact=True):
+    """One source CSV, typed with `schema` and without row numbers when compact."""
+    read = read_csv_cached if use_cache else (lambda path, **kw: pd.read_csv(path, encoding='latin-1', **kw))
+    if not compact:
+        return read(path)
+    return _drop_index_columns(read(path, dtype=schema))
+
+@instrument
+def load_clean_profile(profile_path, reference_date=REFERENCE_DATE, use_cache=True, compact=True):
+    """The cleaned profile table (see clean_profile), cached by source hash and reference date.
+
+    A repeat call on an unchanged file with the same reference date reads
+    the cleaned table back from Parquet and skips cleaning entirely.
+    """
+    build = lambda: clean_profile(_read_table(profile_path, PROFILE_SCHEMA, use_cache, compact), reference_date)
+    if not (use_cache and HAS_PYARROW):
+        return build()
+    options = {'clean': 'profile', 'reference_date': pd.Timestamp(reference_date), 'compact': compact}
+    return _cached_frame(profile_path, None, options, build)
+
+@instrument
+def load_dimensions(data_dir='data/', use_cache=True, compact=True, reference_date=REFERENCE_DATE):
+    """Loads and cleans only the small portfolio and profile tables."""
+    portfolio = _read_table(f"{data_dir}portfolio_ofertas.csv", PORTFOLIO_SCHEMA, use_cache, compact)
+    profile = load_clean_profile(f"{data_dir}dados_clientes.csv", reference_date, use_cache, compact)
+    return portfolio, profile
+
+@instrument
+def iter_processed_chunks(data_dir, portfolio, profile, chunksize=250_000, compact=True):
+    """Streaming counterpart of get_processed_data: yields merged event chunks.
+
+    `portfolio` and `profile` come from load_dimensions; each chunk is
+    enriched against them with merge_data.
+    """
+    e_path = f"{data_dir}eventos_ofertas.csv"
+    for chunk in iter_event_chunks(e_path, chunksize=chunksize, compact=compact):
+        yield merge_data(portfolio, chunk, profile)
+
+@instrument
+def parse_yyyymmdd(values):
+    """datetime64 dates of YYYYMMDD integers, by integer arithmetic (no string parsing)."""
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iu':
+        return pd.to_datetime(values, format='%Y%m%d').to_numpy()
+    values = values.astype(np.int64)
+    year, month, day = values // 10000, values // 100 % 100, values % 100
+    months = ((year - 1970) * 12 + (month - 1)).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + (day - 1)
+    # A day past the end of its month rolls over into the next one
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (dates.astype('datetime64[M]') == months)
+    if not valid.all():
+        raise ValueError(f"Invalid YYYYMMDD date: {values[~valid][0]}")
+    return dates.astype('datetime64[us]')
+
+@instrument
+def clean_profile(profile, reference_date=REFERENCE_DATE):
+    """Cleans the profile table; anos_de_membro is measured at reference_date."""
+    if profile['membro_desde'].dtype.kind != 'M':
+        profile['membro_desde'] = parse_yyyymmdd(profile['membro_desde'].to_numpy())
     profile['renda_anual'] = profile['renda_anual'].fillna(profile['renda_anual'].median())
+    if isinstance(profile['genero'].dtype, pd.CategoricalDtype) and 'O' not in profile['genero'].cat.categories:
+        profile['genero'] = profile['genero'].cat.add_categories('O')
     profile['genero'] = profile['genero'].fillna('O')
     
     # Feature Engineering
-    current = pd.Timestamp.now()
-    profile['anos_de_membro'] = (current - profile['membro_desde']).dt.days / 365.25
-    
-    return portfolio, events, profile
+    profile['anos_de_membro'] = (pd.Timestamp(reference_date) - profile['membro_desde']).dt.days / 365.25
+    return profile
 
+@instrument
+def clean_data(portfolio, events, profile, reference_date=REFERENCE_DATE):
+    """Cleans and preprocesses data (Steps 1-2).
+
+    Only the profile needs cleaning. A fixed reference_date (rather than
+    today) makes the output the same on every run, so it can be cached.
+    """
+    return portfolio, events, clean_profile(profile, reference_date)
+
+def _share_categories(left, right, key):
+    """Gives a categorical join key the same categories on both sides.
+
+    pandas only keeps a merge key integer-coded when both dtypes match.
+    """
+    if not (isinstance(left[key].dtype, pd.CategoricalDtype) and isinstance(right[key].dtype, pd.CategoricalDtype)):
+        return left, right
+    categories = left[key].cat.categories.union(right[key].cat.categories)
+    left = left.assign(**{key: left[key].cat.set_categories(categories)})
+    right = right.assign(**{key: right[key].cat.set_categories(categories)})
+    return left, right
+
+@instrument
 def merge_data(portfolio, events, profile):
     """Merges datasets into a master dataframe (Step 3)."""
     portfolio = portfolio.rename(columns={'id': 'id_oferta'})
     profile = profile.rename(columns={'id': 'cliente'})
-    
-    merged_df = events.merge(portfolio, on='id_oferta', how='left')
-    merged_df = merged_df.merge(profile, on='cliente', how='left')
-    
+    merged_df = _join_dimension(events, portfolio, 'id_oferta')
+    merged_df = _join_dimension(merged_df, profile, 'cliente')
     return merged_df
 
-def get_processed_data(data_dir='data/'):
-    """High-level function to get the final merged dataframe."""
-    p_path = f"{data_dir}portfolio_ofertas.csv"
-    e_path = f"{data_dir}eventos_ofertas.csv"
-    pr_path = f"{data_dir}dados_clientes.csv"
-    
-    port, ev, prof = load_data(p_path, e_path, pr_path)
-    port, ev, prof = clean_data(port, ev, prof)
+def _join_dimension(events, dim, key):
+    """Left join of a dimension table on `key` (one step of merge_data)."""
+    events, dim = _share_categories(events, dim, key)
+    merged_df = events.merge(dim, on=key, how='left')
+
+    # Left joins turn narrow integer columns into float64 to hold NaN;
+    # float32 is exact for these small values. Columns the events also have
+    # come out of the merge with the '_y' suffix.
+    for col in dim.columns:
+        merged_col = col if col == key or col not in events else f"{col}_y"
+        narrow = dim[col].dtype.kind in 'iu' and dim[col].dtype.itemsize < 8
+        if narrow and merged_col in merged_df and merged_df[merged_col].dtype == 'float64':
+            merged_df[merged_col] = merged_df[merged_col].astype('float32')
+    return merged_df
+
+class StarSchema:
+    """Events fact table plus offer and customer dimension tables.
+
+    Facts carry integer surrogate keys (oferta_key, cliente_key) instead of
+    the denormalized portfolio/profile columns. A key is the row position in
+    its dimension, so attributes are fetched with a positional take; -1 marks
+    an event with no id (e.g. id_oferta on transactions).
+    """
+
+    KEYS = {'offers': 'oferta_key', 'customers': 'cliente_key'}
+
+    def __init__(self, facts, offers, customers):
+        self.facts = facts
+        self.offers = offers
+        self.customers = customers
+
+    @property
+    def shape(self):
+        return self.facts.shape
+
+    def _dimension(self, column):
+        if column in self.offers.columns:
+            return self.offers, self.KEYS['offers']
+        if column in self.customers.columns:
+            return self.customers, self.KEYS['customers']
+        raise KeyError(column)
+
+    def attribute(self, column, rows=None):
+        """Dimension column aligned to the given fact rows (all facts by default)."""
+        rows = self.facts if rows is None else rows
+        dim, key_col = self._dimension(column)
+        keys = rows[key_col].to_numpy()
+        values = dim[column].take(np.maximum(keys, 0))
+        values = pd.Series(values.array, index=rows.index, name=column)
+        if (keys < 0).any():
+            values = values.where(keys >= 0)
+        return values
+
+    def select(self, columns, event_types=None):
+        """Narrow frame of `columns` for the events of the given types.
+
+        Filtering happens on the fact table first; dimension columns are
+        looked up only for the surviving rows.
+        """
+        rows = self.facts
+        if event_types is not None:
+            rows = rows[rows['tipo_evento'].isin(event_types)]
+        data = {col: rows[col] if col in rows.columns else self.attribute(col, rows) for col in columns}
+        return pd.DataFrame(data, index=rows.index)
+
+    def take(self, rows, columns):
+        """Narrow frame of `columns` for the fact rows at positions `rows`."""
+        facts = self.facts.take(rows)
+        data = {col: facts[col] if col in facts.columns else self.attribute(col, facts) for col in columns}
+        return pd.DataFrame(data, index=facts.index)
+
+    def customers_with_events(self):
+        """Customer dimension rows referenced by at least one event."""
+        keys = np.unique(self.facts[self.KEYS['customers']].to_numpy())
+        return self.customers.take(keys[keys >= 0])
+
+def _surrogate_keys(ids, dim, key):
+    """Integer keys of `ids` into `dim`, reordered to follow the key categories.
+
+    Ids missing from the dimension get an all-NaN row, matching the left join
+    done by merge_data.
+    """
+    if not isinstance(ids.dtype, pd.CategoricalDtype):
+        ids = ids.astype('category')
+    categories = ids.cat.categories.union(pd.Index(dim[key].astype(object).unique()))
+    ids = ids.cat.set_categories(categories)
+    dim = dim.set_index(dim[key].astype(object)).drop(columns=key)
+    dim = dim.reindex(categories).rename_axis(key).reset_index()
+    return ids.cat.codes, dim
+
+@instrument
+def build_star_schema(portfolio, events, profile):
+    """Splits the cleaned data into a StarSchema instead of merging it (Step 3)."""
+    portfolio = portfolio.rename(columns={'id': 'id_oferta'})
+    profile = profile.rename(columns={'id': 'cliente'})
+
+    oferta_key, offers = _surrogate_keys(events['id_oferta'], portfolio, 'id_oferta')
+    cliente_key, customers = _surrogate_keys(events['cliente'], profile, 'cliente')
+
+    facts = events.drop(columns=['id_oferta', 'cliente'])
+    facts.insert(0, 'oferta_key', oferta_key)
+    facts.insert(0, 'cliente_key', cliente_key)
+    return StarSchema(facts, offers, customers)
+
+def _sorted_codes(uniques, codes):
+    # Renumber codes so that the uniques they point to are sorted
+    uniques = np.asarray(uniques, dtype=object)
+    if pd.Index(uniques).is_monotonic_increasing:
+        return codes, uniques
+    by_value = np.argsort(uniques)
+    rank = np.empty(len(uniques), dtype=np.int64)
+    rank[by_value] = np.arange(len(uniques))
+    return np.where(codes >= 0, rank[np.maximum(codes, 0)], -1), uniques[by_value]
+
+@instrument
+def sorted_codes(values):
+    """Integer codes (-1 for missing) of a column and its distinct values, sorted.
+
+    Code order follows value order whatever the dtype (categorical
+    categories need not be sorted), so results keyed by codes come out in
+    the same order from a merged frame or a StarSchema.
+    """
+    codes, uniques = pd.factorize(values, sort=True)
+    return _sorted_codes(uniques, codes.astype(np.int64))
+
+class CustomerIndex:
+    """Event rows grouped by customer (CSR layout).
+
+    ids holds the customers with events, sorted; the rows of ids[i] are
+    order[offsets[i]:offsets[i + 1]], positions into the events in event
+    order. A customer's events are then a binary search plus a slice instead
+    of a scan of the cliente column, and per-customer sweeps run over
+    contiguous runs. Only positions are stored: pass the frame (or
+    StarSchema) the index was built from to select().
+    """
+
+    def __init__(self, df):
+        if isinstance(df, StarSchema):
+            # Keys are positions in the customer dimension
+            keys = df.facts[StarSchema.KEYS['customers']].to_numpy()
+            present = np.unique(keys[keys >= 0])
+            codes = np.full(len(df.customers), -1, dtype=np.int64)
+            codes[present] = np.arange(len(present))
+            codes = np.where(keys >= 0, codes[np.maximum(keys, 0)], -1)
+            ids = df.customers['cliente'].take(present)
+            codes, ids = _sorted_codes(ids.to_numpy(dtype=object), codes)
+        else:
+            codes, ids = sorted_codes(df['cliente'])
+        self.ids = pd.Index(ids, name='cliente')
+        self._sorted_ids = ids
+
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.ids))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        order = np.argsort(codes, kind='stable')
+        # Events without a customer (code -1) sort first; leave them out
+        self.order = order[len(order) - self.offsets[-1]:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, cliente):
+        """Row positions of a customer's events, in event order (KeyError if unknown)."""
+        # Binary search over the sorted ids
+        i = np.searchsorted(self._sorted_ids, cliente)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != cliente:
+            raise KeyError(cliente)
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def first_rows(self):
+        """Row position of each customer's first event, aligned with ids."""
+        return self.order[self.offsets[:-1]]
+
+    def select(self, df, cliente, columns=None):
+        """A customer's events from `df` (the indexed frame or StarSchema)."""
+        rows = self.rows(cliente)
+        if isinstance(df, StarSchema):
+            return df.take(rows, columns or list(df.facts.columns))
+        return df.take(rows) if columns is None else df[columns].take(rows)
+
+_CUSTOMER_INDEXES = {}
+
+def customer_index(df):
+    """CustomerIndex of a merged frame or StarSchema, built on first use.
+
+    Kept for as long as `df` lives, so kpis and visualization share one
+    index per dataset. Frames are treated as immutable once indexed.
+    """
+    key = id(df)
+    if key not in _CUSTOMER_INDEXES:
+        _CUSTOMER_INDEXES[key] = CustomerIndex(df)
+        weakref.finalize(df, _CUSTOMER_INDEXES.pop, key, None)
+    return _CUSTOMER_INDEXES[key]
+
+@instrument
+def get_processed_data(data_dir='data/', use_cache=True, compact=True, star=False, reference_date=REFERENCE_DATE):
+    """High-level function to get the final merged dataframe (or a StarSchema with star=True)."""
+    port, prof = load_dimensions(data_dir, use_cache=use_cache, compact=compact, reference_date=reference_date)
+    ev = _read_table(f"{data_dir}eventos_ofertas.csv", EVENTS_SCHEMA, use_cache, compact)
+    if star:
+        return build_star_schema(port, ev, prof)
     final_df = merge_data(port, ev, prof)
     
     return final_df
+
+# Master frame columns, in get_processed_data order -> (source table, column
+# in that table). Events and portfolio both have recompensa; the merge
+# suffixes them _x and _y.
+MASTER_SOURCES = {
+    'cliente': ('events', 'cliente'),
+    'tipo_evento': ('events', 'tipo_evento'),
+    'tempo_decorrido': ('events', 'tempo_decorrido'),
+    'id_oferta': ('events', 'id_oferta'),
+    'valor': ('events', 'valor'),
+    'recompensa_x': ('events', 'recompensa'),
+    'recompensa_y': ('portfolio', 'recompensa'),
+    'canal': ('portfolio', 'canal'),
+    'valor_minimo': ('portfolio', 'valor_minimo'),
+    'duracao': ('portfolio', 'duracao'),
+    'oferta': ('portfolio', 'oferta'),
+    'genero': ('profile', 'genero'),
+    'idade': ('profile', 'idade'),
+    'membro_desde': ('profile', 'membro_desde'),
+    'renda_anual': ('profile', 'renda_anual'),
+    'anos_de_membro': ('profile', 'anos_de_membro'),
+}
+DIMENSION_KEYS = {'portfolio': 'id_oferta', 'profile': 'cliente'}
+
+class LazyDataset:
+    """Deferred query over the get_processed_data frame.
+
+    where() and select() only record the query; collect() then reads the
+    event columns it needs through the Parquet cache with the event filters
+    pushed into the read, and joins portfolio/profile only when a selected
+    or filtered column comes from them. Filters on dimension columns are
+    applied to the (small) dimension table, and events are restricted to
+    the surviving keys before the join. Always compact dtypes.
+    """
+
+    def __init__(self, data_dir='data/', use_cache=True, columns=None, filters=(), reference_date=REFERENCE_DATE):
+        self.data_dir = data_dir
+        self.use_cache = use_cache
+        self.reference_date = reference_date
+        self.columns = list(MASTER_SOURCES) if columns is None else list(columns)
+        self.filters = tuple(filters)
+
+    def _replace(self, **changes):
+        state = {
+            'data_dir': self.data_dir, 'use_cache': self.use_cache, 'columns': self.columns,
+            'filters': self.filters, 'reference_date': self.reference_date,
+        }
+        state.update(changes)
+        return LazyDataset(**state)
+
+    def where(self, column, op, value):
+        """Adds a (column, op, value) row filter; ops as in apply_filters."""
+        if column not in MASTER_SOURCES:
+            raise KeyError(column)
+        if op not in _FILTER_OPS:
+            raise ValueError(f"Unknown filter op: {op!r}")
+        return self._replace(filters=self.filters + ((column, op, value),))
+
+    def select(self, columns):
+        """Keeps only `columns` (in that order)."""
+        missing = [col for col in columns if col not in self.columns]
+        if missing:
+            raise KeyError(missing)
+        return self._replace(columns=list(columns))
+
+    def _sources(self, columns):
+        needed = {}
+        for col in columns:
+            source, source_col = MASTER_SOURCES[col]
+            needed.setdefault(source, []).append(source_col)
+        return needed
+
+    @instrument
+    def collect(self):
+        """Reads, filters and joins; returns a frame with the selected columns."""
+        filter_columns = [column for column, _, _ in self.filters]
+        needed = self._sources(list(dict.fromkeys(self.columns + filter_columns)))
+        filters = {source: [] for source in ('events', 'portfolio', 'profile')}
+        for column, op, value in self.filters:
+            source, source_col = MASTER_SOURCES[column]
+            filters[source].append((source_col, op, value))
+
+        # 1. Events: only the needed columns (plus join keys), filtered while reading
+        event_cols = list(needed.get('events', []))
+        for source, key in DIMENSION_KEYS.items():
+            if source in needed and key not in event_cols:
+                event_cols.append(key)
+        events = self._read('eventos_ofertas.csv', EVENTS_SCHEMA, list(dict.fromkeys(event_cols)), filters['events'])
+
+        # 2. Dimensions: filtered first, then joined only if used
+        if 'portfolio' in needed or 'profile' in needed:
+            portfolio, profile = load_dimensions(self.data_dir, use_cache=self.use_cache, reference_date=self.reference_date)
+            dims = {
+                'portfolio': portfolio.rename(columns={'id': 'id_oferta'}),
+                'profile': profile.rename(columns={'id': 'cliente'}),
+            }
+            for source, key in DIMENSION_KEYS.items():
+                if source not in needed:
+                    continue
+                dim = apply_filters(dims[source], filters[source])
+                dim = dim[[key] + [col for col in dict.fromkeys(needed[source]) if col != key]]
+                if filters[source]:
+                    events = events[events[key].isin(dim[key])].reset_index(drop=True)
+                events = _join_dimension(events, dim, key)
+        if 'recompensa' in events.columns:
+            # Only one side of the events/portfolio recompensa pair was read, so the merge added no suffix
+            events = events.rename(columns={'recompensa': 'recompensa_x' if 'recompensa' in needed.get('events', []) else 'recompensa_y'})
+        return events[self.columns]
+
+    def _read(self, file_name, schema, columns, filters):
+        path = os.path.join(self.data_dir, file_name)
+        if self.use_cache:
+            return read_csv_cached(path, columns=columns, filters=filters, dtype=schema)
+        return apply_filters(pd.read_csv(path, encoding='latin-1', usecols=columns, dtype=schema), filters)
+
+# --- Memory-mapped event store ---
+# A StarSchema saved as one .npy file per column: categorical and string
+# columns as integer codes plus a fixed-width array of their labels. Opened
+# with np.load(mmap_mode='r'), so every process reading the store shares the
+# same page-cache pages instead of holding its own parsed copy.
+
+EVENT_STORE_NAME = 'event_store'
+# Bump when the stored layout or the cleaning it captures changes
+EVENT_STORE_VERSION = 2
+EVENT_STORE_FRAMES = ('facts', 'offers', 'customers')
+
+def _narrow_int(values):
+    """Integer array in the smallest signed dtype holding its range."""
+    low, high = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype, copy=False)
+    return values.astype(np.int64, copy=False)
+
+def _save_labels(path, labels):
+    labels = np.asarray(labels)
+    if labels.dtype == object:
+        labels = labels.astype(str)  # fixed-width unicode, loadable without pickle
+    np.save(path, labels)
+
+def _write_frame(frame, frame_dir):
+    """One .npy per column; returns the column specs for the store metadata."""
+    os.makedirs(frame_dir)
+    specs = []
+    for i, (name, column) in enumerate(frame.items()):
+        path = os.path.join(frame_dir, f"{i:03d}")
+        spec = {'name': name, 'dtype': str(column.dtype)}
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            spec.update(kind='category', ordered=bool(column.cat.ordered))
+            codes, labels = column.cat.codes.to_numpy(), column.cat.categories
+        elif column.dtype.kind in 'biufmM':
+            spec['kind'] = 'values'
+            np.save(path + '.npy', column.to_numpy())
+            specs.append(spec)
+            continue
+        else:
+            # Strings/objects: stored like a categorical, restored to their dtype
+            spec['kind'] = 'labels'
+            codes, labels = pd.factorize(column)
+        np.save(path + '.npy', _narrow_int(codes))
+        _save_labels(path + '.labels.npy', labels)
+        specs.append(spec)
+    return specs
+
+def _open_frame(frame_dir, specs, n_rows):
+    data = {}
+    for i, spec in enumerate(specs):
+        path = os.path.join(frame_dir, f"{i:03d}")
+        # Plain ndarray view of the map: no copy, and no memmap subclass leaking into results
+        values = np.asarray(np.load(path + '.npy', mmap_mode='r'))
+        if spec['kind'] != 'values':
+            labels = pd.Index(np.load(path + '.labels.npy'))
+            if labels.dtype.kind == 'U':
+                labels = labels.astype(object)
+            if spec['kind'] == 'category':
+                values = pd.Categorical.from_codes(values, dtype=pd.CategoricalDtype(labels, ordered=spec['ordered']))
+            else:
+                values = pd.Categorical.from_codes(values, categories=labels).astype(pd.api.types.pandas_dtype(spec['dtype']))
+        data[spec['name']] = pd.Series(values, copy=False)
+    return pd.DataFrame(data, index=pd.RangeIndex(n_rows), copy=False)
+
+def _source_stats(paths):
+    stats = {}
+    for path in paths:
+        stat = os.stat(path)
+        stats[os.path.abspath(path)] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': _file_hash(path)}
+    return stats
+
+@instrument
+def write_event_store(star, store_dir, sources=(), reference_date=None):
+    """Saves a StarSchema as a memory-mapped event store; returns store_dir.
+
+    Frames are saved with a fresh RangeIndex (row order is kept). `sources`
+    are the files the data came from and reference_date the one it was
+    cleaned with; get_event_store rebuilds the store when either changes.
+    The store is written next to store_dir and swapped in, so readers
+    never see a half-written store.
+    """
+    store_dir = os.path.abspath(store_dir)
+    tmp_dir = f"{store_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    meta = {
+        'version': EVENT_STORE_VERSION,
+        'reference_date': None if reference_date is None else str(pd.Timestamp(reference_date)),
+        'sources': _source_stats(sources),
+        'frames': {},
+    }
+    for name in EVENT_STORE_FRAMES:
+        frame = getattr(star, name)
+        meta['frames'][name] = {'rows': len(frame), 'columns': _write_frame(frame, os.path.join(tmp_dir, name))}
+    with open(os.path.join(tmp_dir, 'store.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Processes that have the old store mapped keep reading its (unlinked) files
+    old_dir = f"{store_dir}.old-{os.getpid()}"
+    if os.path.exists(store_dir):
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return store_dir
+
+def _read_store_meta(store_dir):
+    try:
+        with open(os.path.join(store_dir, 'store.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+@instrument
+def open_event_store(store_dir):
+    """StarSchema whose columns are read-only memory maps of a saved event store.
+
+    Opening reads no event data; pages are loaded on first access and shared
+    between processes. Filters, takes and groupbys work as usual and only
+    copy what they select.
+    """
+    meta = _read_store_meta(store_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No event store in {store_dir}")
+    frames = {
+        name: _open_frame(os.path.join(store_dir, name), spec['columns'], spec['rows'])
+        for name, spec in meta['frames'].items()
+    }
+    return StarSchema(frames['facts'], frames['offers'], frames['customers'])
+
+def _event_store_current(store_dir, sources, reference_date):
+    meta = _read_store_meta(store_dir)
+    if meta is None or meta.get('version') != EVENT_STORE_VERSION:
+        return False
+    if meta['reference_date'] != str(pd.Timestamp(reference_date)):
+        return False
+    stored = meta['sources']
+    for path in sources:
+        entry = stored.get(os.path.abspath(path))
+        stat = os.stat(path)
+        if entry is None or entry['size'] != stat.st_size:
+            return False
+        # Same check order as read_csv_cached: content is hashed only if touched
+        if entry['mtime'] != stat.st_mtime_ns and entry['sha1'] != _file_hash(path):
+            return False
+    return len(stored) == len(sources)
+
+@instrument
+def get_event_store(data_dir='data/', store_dir=None, rebuild=False, reference_date=REFERENCE_DATE):
+    """Memory-mapped StarSchema of the processed data, built on first use.
+
+    The store lives in <data_dir>/.cache/event_store/ by default and is
+    rebuilt (through get_processed_data) when a source CSV's content or the
+    reference date changes.
+    """
+    if store_dir is None:
+        store_dir = os.path.join(data_dir, CACHE_DIR_NAME, EVENT_STORE_NAME)
+    sources = [os.path.join(data_dir, name) for name in ('portfolio_ofertas.csv', 'eventos_ofertas.csv', 'dados_clientes.csv')]
+    if rebuild or not _event_store_current(store_dir, sources, reference_date):
+        star = get_processed_data(data_dir, star=True, reference_date=reference_date)
+        write_event_store(star, store_dir, sources, reference_date)
+    return open_event_store(store_dir)
+
+@instrument
+def memory_report(data_dir='data/', use_cache=True):
+    """Compares the deep memory footprint (MB) of the untyped and compact master frames.
+
+    The CSV row-number columns, which the compact frame drops, are left
+    out of both sides.
+    """
+    before = _drop_index_columns(get_processed_data(data_dir, use_cache=use_cache, compact=False))
+    after = get_processed_data(data_dir, use_cache=use_cache, compact=True)
+
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'mb_before': before.memory_usage(deep=True, index=False) / 1e6,
+        'dtype_after': after.dtypes.astype(str),
+        'mb_after': after.memory_usage(deep=True, index=False) / 1e6,
+    })
+    report.loc['TOTAL', ['mb_before', 'mb_after']] = [report['mb_before'].sum(), report['mb_after'].sum()]
+    report['reduction'] = report['mb_before'] / report['mb_after']
+    return report
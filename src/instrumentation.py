@@ -0,0 +1,205 @@
+import contextlib
+import csv
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Set to a report path (.json or .csv) to profile a run
+ENV_VAR = 'PIPELINE_PROFILE'
+
+_state = {'enabled': False}
+_records = []
+_local = threading.local()
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def enabled():
+    return _state['enabled']
+
+def enable():
+    """Starts recording instrumented calls.
+
+    Allocations are traced with tracemalloc for the memory peaks, which
+    slows pandas/matplotlib-heavy code down two to three times.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _state['enabled'] = True
+
+def disable():
+    _state['enabled'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def reset():
+    del _records[:]
+
+def records():
+    """Recorded calls, in completion order."""
+    return list(_records)
+
+def row_count(obj):
+    """Row count of a frame-like object (or the sum over a tuple of them); None otherwise."""
+    if hasattr(obj, 'shape') and len(obj.shape) > 0:
+        return int(obj.shape[0])
+    if hasattr(obj, 'source'):  # EventPartitions
+        return row_count(obj.source)
+    if isinstance(obj, (tuple, list)):
+        counts = [n for n in (row_count(item) for item in obj) if n is not None]
+        return sum(counts) if counts else None
+    return None
+
+@contextlib.contextmanager
+def profile_block(name, rows_in=None):
+    """Records wall/CPU time and the traced-memory peak of a block.
+
+    Yields a dict; set its 'rows_out' to record output rows. Nested blocks
+    each see their own peak: the tracemalloc peak is reset on entry and
+    handed back to the enclosing block on exit.
+    """
+    info = {'rows_out': None}
+    if not _state['enabled']:
+        yield info
+        return
+
+    stack = _stack()
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+    tracemalloc.reset_peak()
+    frame = {'start': current, 'peak': current}
+    stack.append(frame)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield info
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _, peak = tracemalloc.get_traced_memory()
+        stack.pop()
+        frame['peak'] = max(frame['peak'], peak)
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+        tracemalloc.reset_peak()
+        _records.append({
+            'name': name,
+            'depth': len(stack),
+            'pid': os.getpid(),
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'peak_mem_delta_mb': (frame['peak'] - frame['start']) / 1e6,
+            'rows_in': rows_in,
+            'rows_out': info['rows_out'],
+        })
+
+def instrument(func):
+    """Decorator: records every call of `func` while profiling is enabled.
+
+    rows_in sums the rows of the frame-like positional arguments, rows_out
+    counts the rows of the result. A generator function records one call
+    per yielded item (the work done to produce it). Costs one flag check
+    when disabled.
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                with profile_block(name) as info:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    info['rows_out'] = row_count(item)
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state['enabled']:
+            return func(*args, **kwargs)
+        counts = [n for n in (row_count(a) for a in args) if n is not None]
+        with profile_block(name, rows_in=sum(counts) if counts else None) as info:
+            result = func(*args, **kwargs)
+            info['rows_out'] = row_count(result)
+        return result
+    return wrapper
+
+def _call_collected(func, name, *args, **kwargs):
+    # Runs in a worker process: returns the result with the records it made
+    if not _state['enabled']:
+        return func(*args, **kwargs), []
+    start = len(_records)
+    # A forked worker inherits the parent's open blocks; start from none
+    saved, _local.stack = _stack(), []
+    try:
+        if name is None:
+            value = func(*args, **kwargs)
+        else:
+            with profile_block(name, row_count(args)) as info:
+                value = func(*args, **kwargs)
+                info['rows_out'] = row_count(value)
+    finally:
+        _local.stack = saved
+    collected = _records[start:]
+    del _records[start:]
+    return value, collected
+
+def collected(func, name=None):
+    """Picklable wrapper for executor.submit/map: returns (result, records).
+
+    Pass the records to absorb() in the parent so calls made in worker
+    processes end up in the report; `name` also records the call itself.
+    """
+    return functools.partial(_call_collected, func, name)
+
+def absorb(worker_records):
+    _records.extend(worker_records)
+
+def summary(calls=None):
+    """Per-function totals: calls, wall/CPU seconds, max peak delta, rows."""
+    calls = pd.DataFrame(records() if calls is None else calls)
+    if calls.empty:
+        return calls
+    table = calls.groupby('name', sort=False).agg(
+        calls=('wall_s', 'size'),
+        wall_s=('wall_s', 'sum'),
+        cpu_s=('cpu_s', 'sum'),
+        peak_mem_delta_mb=('peak_mem_delta_mb', 'max'),
+        rows_in=('rows_in', lambda rows: rows.sum(min_count=1)),
+        rows_out=('rows_out', lambda rows: rows.sum(min_count=1)),
+    )
+    return table.sort_values('wall_s', ascending=False)
+
+def write_report(path):
+    """Writes the recorded calls: one row per call for .csv, else JSON with a summary."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    calls = records()
+    if path.endswith('.csv'):
+        fields = ['name', 'depth', 'pid', 'wall_s', 'cpu_s', 'peak_mem_delta_mb', 'rows_in', 'rows_out']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(calls)
+    else:
+        table = summary(calls)
+        report = {
+            'calls': calls,
+            'summary': json.loads(table.reset_index().to_json(orient='records')) if len(table) else [],
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return path
+
+if os.environ.get(ENV_VAR):
+    enable()
@@ -1,60 +1,1281 @@
+import functools
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
+import numpy as np
 import ast
 
+from src.data_loader import CACHE_DIR_NAME, LazyDataset, StarSchema, customer_index, iter_processed_chunks, load_dimensions, prefix_digest, read_events_since, sorted_codes
+from src.instrumentation import absorb, collected, instrument
+
+class EventPartitions:
+    """Events split by tipo_evento in a single pass.
+
+    Wraps a merged frame or a StarSchema; select() serves any combination of
+    event types from the stored row positions, so repeated KPI filters do
+    not rescan tipo_evento.
+    """
+
+    @instrument
+    def __init__(self, df):
+        self.source = df
+        facts = df.facts if isinstance(df, StarSchema) else df
+        self.positions = facts.groupby('tipo_evento', observed=True, sort=False).indices
+        self._combined = {}
+
+    def rows(self, event_types=None):
+        """Row positions (ascending) of the given event types."""
+        if event_types is None:
+            facts = self.source.facts if isinstance(self.source, StarSchema) else self.source
+            return np.arange(len(facts))
+        key = tuple(sorted(event_types))
+        if key not in self._combined:
+            parts = [self.positions[t] for t in key if t in self.positions]
+            rows = np.concatenate(parts) if parts else np.array([], dtype=np.intp)
+            # Keep the original event order so downstream sums are unchanged
+            self._combined[key] = np.sort(rows) if len(parts) > 1 else rows
+        return self._combined[key]
+
+    def select(self, columns, event_types=None):
+        """Same contract as select_events, materializing only `columns`."""
+        rows = self.rows(event_types)
+        if isinstance(self.source, StarSchema):
+            return self.source.take(rows, columns)
+        data = {col: self.source[col].take(rows) for col in columns}
+        return pd.DataFrame(data)
+
+@instrument
+def select_events(df, columns, event_types=None):
+    """Rows of the given event types, restricted to `columns`.
+
+    Accepts the merged master frame, a StarSchema, EventPartitions or a
+    LazyDataset; for a StarSchema only the requested dimension columns are
+    looked up, and only for matching rows, and a LazyDataset only reads them.
+    """
+    if isinstance(df, LazyDataset):
+        if event_types is not None:
+            df = df.where('tipo_evento', 'in', list(event_types))
+        return df.select(columns).collect()
+    if isinstance(df, (StarSchema, EventPartitions)):
+        return df.select(columns, event_types)
+    if event_types is not None:
+        df = df[df['tipo_evento'].isin(event_types)]
+    return df[columns]
+
+@instrument
 def calculate_ticket_average(df):
     """Calculate mean transaction value."""
-    transactions = df[df['tipo_evento'] == 'transacao']
+    transactions = select_events(df, ['valor'], ['transacao'])
     return transactions['valor'].mean()
 
-def calculate_channel_conversion(df, portfolio):
-    """Calculate conversion rate per channel."""
-    # Explode portfolio channels
-    port_copy = portfolio.copy()
-    port_copy['canais_lista'] = port_copy['canal'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else [])
-    offer_channels = port_copy[['id_oferta', 'canais_lista']].explode('canais_lista')
-    offer_channels = offer_channels.rename(columns={'canais_lista': 'canal_individual'})
+def _parse_channels(canal):
+    """Channel list from a portfolio canal value ("['web', 'email']" or a list)."""
+    if isinstance(canal, str):
+        return list(ast.literal_eval(canal))
+    if isinstance(canal, (list, tuple, np.ndarray)):
+        return list(canal)
+    return []
+
+class OfferChannelIndex:
+    """Offer x channel membership, parsed once per portfolio.
 
-    # Filter events
-    relevant_events = df[df['tipo_evento'].isin(['oferta visualizada', 'oferta concluída'])]
-    relevant_events = relevant_events[['id_oferta', 'tipo_evento']]
+    matrix[i, j] is 1 when offer_ids[i] is published on channels[j]; masks
+    packs each row into an integer bitmask (bit j = channels[j]). Channel
+    totals are then a matrix product of per-offer counts with `matrix`,
+    instead of exploding events into one row per channel.
+    """
 
-    # Join
-    events_with_channels = relevant_events.merge(offer_channels, on='id_oferta', how='inner')
+    def __init__(self, portfolio):
+        canal = portfolio['canal'].astype(object)
+        # literal_eval once per distinct channel string, not once per offer
+        parsed = {value: _parse_channels(value) for value in canal if isinstance(value, str)}
+        lists = [parsed[value] if isinstance(value, str) else _parse_channels(value) for value in canal]
+
+        self.offer_ids = pd.Index(portfolio['id_oferta'].astype(object), name='id_oferta')
+        self.channels = sorted({c for channels in lists for c in channels})
+        position = {c: j for j, c in enumerate(self.channels)}
+
+        self.matrix = np.zeros((len(self.offer_ids), len(self.channels)), dtype=np.int64)
+        for i, channels in enumerate(lists):
+            self.matrix[i, [position[c] for c in channels]] = 1
+        self.masks = self.matrix @ (1 << np.arange(len(self.channels), dtype=np.int64))
+
+    def channel_counts(self, offer_counts):
+        """Per-channel totals of a frame of per-offer counts (index id_oferta, one column per measure)."""
+        offer_counts = offer_counts.copy()
+        offer_counts.index = offer_counts.index.astype(object)
+        counts = offer_counts.reindex(self.offer_ids, fill_value=0)
+        totals = self.matrix.T @ counts.to_numpy()
+        return pd.DataFrame(totals, index=pd.Index(self.channels, name='canal_individual'), columns=counts.columns)
+
+_OFFER_CHANNEL_INDEXES = {}
+
+@instrument
+def offer_channel_index(portfolio):
+    """Cached OfferChannelIndex for a portfolio (keyed on its ids and channel strings)."""
+    key = tuple(zip(portfolio['id_oferta'].astype(str), portfolio['canal'].astype(str)))
+    if key not in _OFFER_CHANNEL_INDEXES:
+        _OFFER_CHANNEL_INDEXES[key] = OfferChannelIndex(portfolio)
+    return _OFFER_CHANNEL_INDEXES[key]
+
+@instrument
+def channel_event_counts(df, portfolio, event_types):
+    """Events of each type per channel (channels x event types), multi-attributed by offer."""
+    events = select_events(df, ['id_oferta', 'tipo_evento'], event_types)
+    offer_counts = events.groupby(['id_oferta', 'tipo_evento'], observed=True).size()
+    return _channel_counts_from_offer_counts(offer_counts, portfolio)
+
+def _channel_counts_from_offer_counts(offer_counts, portfolio):
+    wide = offer_counts.unstack(fill_value=0)
+    wide.columns = wide.columns.astype(object)
+    stats = offer_channel_index(portfolio).channel_counts(wide.sort_index(axis=1))
+    # Channels no counted event reaches are left out, as in an inner join
+    stats = stats[stats.sum(axis=1) > 0]
+    stats.columns.name = 'tipo_evento'
+    return stats
+
+@instrument
+def calculate_channel_conversion(df, portfolio):
+    """Calculate conversion rate per channel."""
+    # Filter events and count them per offer
+    relevant_events = select_events(df, ['id_oferta', 'tipo_evento'], ['oferta visualizada', 'oferta concluída'])
+    offer_counts = relevant_events.groupby(['id_oferta', 'tipo_evento'], observed=True).size()
+    return channel_conversion_from_counts(offer_counts, portfolio)
 
-    # Groupby
-    stats = events_with_channels.groupby(['canal_individual', 'tipo_evento']).size().unstack(fill_value=0)
+@instrument
+def channel_conversion_from_counts(offer_counts, portfolio):
+    """Channel conversion table from event counts indexed by (id_oferta, tipo_evento)."""
+    stats = _channel_counts_from_offer_counts(offer_counts, portfolio)
     
     if 'oferta concluída' in stats.columns and 'oferta visualizada' in stats.columns:
         stats['conversion_rate'] = stats['oferta concluída'] / stats['oferta visualizada']
         return stats.sort_values('conversion_rate', ascending=False)
     return stats
 
-def calculate_revenue_by_offer(df):
-    """Calculate revenue attribution by offer type."""
-    completed = df[df['tipo_evento'] == 'oferta concluída'][['cliente', 'tempo_decorrido', 'oferta']]
-    trans = df[df['tipo_evento'] == 'transacao'][['cliente', 'tempo_decorrido', 'valor']]
-    
-    attributed = completed.merge(trans, on=['cliente', 'tempo_decorrido'], how='inner')
-    return attributed.groupby('oferta')['valor'].sum().sort_values(ascending=False)
+def _expand_ranges(lo, hi):
+    """(owner, position) pairs for the half-open ranges [lo[i], hi[i])."""
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, np.repeat(lo, counts) + (np.arange(counts.sum()) - starts)
+
+@instrument
+def attribute_revenue(df, window='exact', credit='all', anchor=None):
+    """Credit transactions to offers with a sorted sweep over (cliente, tempo_decorrido).
+
+    window: 'exact' (same timestamp), a number of hours (anchor at most N
+    hours before the transaction) or 'duracao' (while the offer is valid,
+    i.e. duracao days after the anchor).
+    anchor: the event that opens the window; 'oferta recebida' for
+    'duracao', 'oferta concluída' otherwise.
+    credit: 'all' gives the full valor to every anchor in the window (so
+    'exact' reproduces the old same-timestamp join); 'last' only to the most
+    recent one.
+
+    Anchors are sorted once on a composite integer key and each transaction
+    finds its window with searchsorted: O(n log n). Returns one row per
+    credited (offer, transaction) pair, indexed by the transaction's row
+    label and in transaction order.
+    """
+    if anchor is None:
+        anchor = 'oferta recebida' if window == 'duracao' else 'oferta concluída'
+    offer_cols = ['cliente', 'tempo_decorrido', 'id_oferta', 'oferta'] + (['duracao'] if window == 'duracao' else [])
+    offers = select_events(df, offer_cols, [anchor]).reset_index(drop=True)
+    trans = select_events(df, ['cliente', 'tempo_decorrido', 'valor'], ['transacao'])
+
+    # Window length (hours) of each anchor
+    if window == 'exact':
+        widths = np.zeros(len(offers))
+    elif window == 'duracao':
+        widths = np.nan_to_num(offers['duracao'].to_numpy(dtype=float)) * 24
+    else:
+        widths = np.full(len(offers), float(window))
+    max_width = int(np.ceil(widths.max())) if len(widths) else 0
+
+    # Composite key: customer code * stride + time. The stride leaves room
+    # for the widest window, so a window never reaches another customer.
+    codes, _ = pd.factorize(pd.concat([offers['cliente'].astype(object), trans['cliente'].astype(object)], ignore_index=True))
+    offer_codes, trans_codes = codes[:len(offers)].astype(np.int64), codes[len(offers):].astype(np.int64)
+    offer_times = offers['tempo_decorrido'].to_numpy(dtype=np.int64)
+    trans_times = trans['tempo_decorrido'].to_numpy(dtype=np.int64)
+    t_min = min(offer_times.min(initial=0), trans_times.min(initial=0))
+    t_max = max(offer_times.max(initial=0), trans_times.max(initial=0))
+    stride = (t_max - t_min) + max_width + 1
 
+    offer_keys = offer_codes * stride + (offer_times - t_min) + max_width
+    trans_keys = trans_codes * stride + (trans_times - t_min) + max_width
+    order = np.argsort(offer_keys, kind='stable')
+    sorted_keys = offer_keys[order]
+
+    hi = np.searchsorted(sorted_keys, trans_keys, side='right')
+    lo = np.searchsorted(sorted_keys, trans_keys - max_width, side='left')
+    trans_idx, sorted_pos = _expand_ranges(lo, hi)
+    offer_idx = order[sorted_pos]
+
+    # Per-anchor windows (duracao) are narrower than the search bound
+    keep = (trans_times[trans_idx] - offer_times[offer_idx]) <= widths[offer_idx]
+    trans_idx, offer_idx = trans_idx[keep], offer_idx[keep]
+    if credit == 'last':
+        # Pairs come grouped by transaction with anchors in time order
+        last = np.append(trans_idx[1:] != trans_idx[:-1], True)
+        trans_idx, offer_idx = trans_idx[last], offer_idx[last]
+    elif credit != 'all':
+        raise ValueError(f"credit must be 'all' or 'last', got {credit!r}")
+
+    return pd.DataFrame({
+        'cliente': trans['cliente'].take(trans_idx).to_numpy(),
+        'id_oferta': offers['id_oferta'].take(offer_idx).to_numpy(),
+        'oferta': offers['oferta'].take(offer_idx).to_numpy(),
+        'tempo_oferta': offer_times[offer_idx],
+        'tempo_decorrido': trans_times[trans_idx],
+        'valor': trans['valor'].to_numpy()[trans_idx],
+    }, index=trans.index[trans_idx])
+
+@instrument
+def calculate_revenue_by_offer(df, window='exact', credit='all'):
+    """Calculate revenue attribution by offer type (see attribute_revenue for the options)."""
+    attributed = attribute_revenue(df, window=window, credit=credit)
+    return attributed.groupby('oferta', observed=True)['valor'].sum().sort_values(ascending=False)
+
+@instrument
 def calculate_rfm(df):
     """Calculate RFM metrics and segments."""
-    transactions = df[df['tipo_evento'] == 'transacao']
+    return score_rfm(rfm_base(df))
+
+@instrument
+def rfm_base(df, attributions=()):
+    """Unscored per-customer Recency/Frequency/Monetary (sorted by cliente).
+
+    Each attribute_revenue (window, credit) pair in `attributions` adds a
+    Monetary column (see rfm_monetary_column) with the revenue credited to
+    offers under that definition, 0 for customers with none. Computed once,
+    it can be scored under many scenarios (compare_rfm_scenarios).
+    """
+    parts = df if not attributions or isinstance(df, (EventPartitions, LazyDataset)) else EventPartitions(df)
+    transactions = select_events(parts, ['cliente', 'tempo_decorrido', 'valor'], ['transacao'])
     max_time = transactions['tempo_decorrido'].max()
     
-    rfm = transactions.groupby('cliente').agg({
-        'tempo_decorrido': lambda x: max_time - x.max(),
-        'cliente': 'count',
-        'valor': 'sum'
-    }).rename(columns={'tempo_decorrido': 'Recency', 'cliente': 'Frequency', 'valor': 'Monetary'})
+    # Built-in reductions only (no Python lambda per customer)
+    rfm = transactions.groupby('cliente', observed=True).agg(
+        Recency=('tempo_decorrido', 'max'),
+        Frequency=('tempo_decorrido', 'size'),
+        Monetary=('valor', 'sum'),
+    )
+    rfm['Recency'] = max_time - rfm['Recency']
+    rfm['Monetary'] = _cents(rfm['Monetary'])
+
+    for window, credit in attributions:
+        attributed = attribute_revenue(parts, window=window, credit=credit)
+        revenue = attributed.groupby('cliente', observed=True)['valor'].sum()
+        column = rfm_monetary_column((window, credit))
+        rfm[column] = revenue.reindex(rfm.index, fill_value=0.0).to_numpy(dtype=np.float64)
     
-    # Scoring
+    return rfm
+
+@instrument
+def rfm_reference_time(df):
+    """Latest transaction time: what calculate_rfm measures Recency from."""
+    return select_events(df, ['tempo_decorrido'], ['transacao'])['tempo_decorrido'].max()
+
+def rfm_monetary_column(attribution=None):
+    """rfm_base column holding Monetary under an attribution (None: every transaction)."""
+    if attribution is None:
+        return 'Monetary'
+    window, credit = attribution
+    return f"Monetary[{window},{credit}]"
+
+@instrument
+def score_rfm(rfm):
+    """Add 1-5 quintile scores to a Recency/Frequency/Monetary table (sorted by cliente)."""
+    rfm = rfm.copy()
     rfm['R_Score'] = pd.qcut(rfm['Recency'], 5, labels=[5, 4, 3, 2, 1]).astype(int)
     rfm['F_Score'] = pd.qcut(rfm['Frequency'].rank(method='first'), 5, labels=[1, 2, 3, 4, 5]).astype(int)
     rfm['M_Score'] = pd.qcut(rfm['Monetary'].rank(method='first'), 5, labels=[1, 2, 3, 4, 5]).astype(int)
     
     return rfm
 
+def _cents(monetary):
+    # valor is in whole cents: rounding every sum to cents makes chunked,
+    # merged and one-pass totals the same float, so rank ties agree
+    return monetary.round(2)
+
+def empty_rfm_state():
+    """Per-customer RFM state: last transaction time, transaction count and total spent."""
+    state = pd.DataFrame({
+        'last_time': pd.Series(dtype='int64'),
+        'Frequency': pd.Series(dtype='int64'),
+        'Monetary': pd.Series(dtype='float64'),
+    })
+    state.index.name = 'cliente'
+    return state
+
+@instrument
+def rfm_state_from_transactions(transactions):
+    """RFM state of a transactions frame (cliente, tempo_decorrido, valor)."""
+    state = transactions.groupby('cliente', observed=True).agg(
+        last_time=('tempo_decorrido', 'max'),
+        Frequency=('tempo_decorrido', 'size'),
+        Monetary=('valor', 'sum'),
+    )
+    state.index = state.index.astype(object)
+    state['Monetary'] = _cents(state['Monetary'])
+    return state.astype({'last_time': 'int64', 'Frequency': 'int64', 'Monetary': 'float64'})
+
+@instrument
+def merge_rfm_states(*states):
+    """Combine RFM states (max of last_time, sums of the rest) in one groupby."""
+    states = [state for state in states if not state.empty]
+    if not states:
+        return empty_rfm_state()
+    if len(states) == 1:
+        merged = states[0].copy()
+    else:
+        merged = pd.concat(states).groupby(level=0).agg({'last_time': 'max', 'Frequency': 'sum', 'Monetary': 'sum'})
+    merged['Monetary'] = _cents(merged['Monetary'])
+    return merged
+
+@instrument
+def rfm_from_state(state, max_time=None):
+    """Scored RFM table from an RFM state; Recency is measured from `max_time` (default: latest purchase)."""
+    state = state.sort_index()
+    if max_time is None:
+        max_time = state['last_time'].max()
+    rfm = pd.DataFrame({
+        'Recency': max_time - state['last_time'],
+        'Frequency': state['Frequency'],
+        'Monetary': state['Monetary'],
+    })
+    rfm.index.name = 'cliente'
+    return score_rfm(rfm)
+
+class KPIAccumulator:
+    """Mergeable partial aggregates behind the streaming KPI path.
+
+    Each update() folds one event chunk into small running tables (sizes
+    bounded by offers and customers, not events); merge() combines two
+    accumulators, e.g. from separate files or workers. Revenue attribution
+    joins within a chunk, so chunks must not split a tempo_decorrido value
+    (data_loader.iter_event_chunks guarantees this).
+
+    Per-chunk RFM states are kept aside and folded into the running state
+    every RFM_MERGE_BATCH chunks, so the (customer-sized) running state is
+    regrouped once per batch rather than once per chunk.
+    """
+
+    RFM_MERGE_BATCH = 64
+
+    def __init__(self):
+        self.ticket_sum = 0.0
+        self.ticket_count = 0
+        self.offer_counts = pd.Series(dtype='int64')
+        self.revenue = pd.Series(dtype='float64')
+        self._rfm_states = []
+
+    @property
+    def rfm_state(self):
+        """Running RFM state, with the pending chunk states folded in."""
+        if len(self._rfm_states) != 1:
+            self._rfm_states = [merge_rfm_states(*self._rfm_states)]
+        return self._rfm_states[0]
+
+    @instrument
+    def update(self, chunk):
+        """Fold one merged event chunk into the running aggregates."""
+        trans = select_events(chunk, ['cliente', 'tempo_decorrido', 'valor'], ['transacao'])
+        self.ticket_sum += trans['valor'].sum()
+        self.ticket_count += int(trans['valor'].count())
+
+        relevant = select_events(chunk, ['id_oferta', 'tipo_evento'], ['oferta visualizada', 'oferta concluída'])
+        counts = relevant.groupby(['id_oferta', 'tipo_evento'], observed=True).size()
+        self.offer_counts = self._add(self.offer_counts, counts)
+
+        attributed = attribute_revenue(chunk, window='exact')
+        revenue = attributed.groupby('oferta', observed=True)['valor'].sum()
+        self.revenue = self._add(self.revenue, revenue)
+
+        self._rfm_states.append(rfm_state_from_transactions(trans))
+        if len(self._rfm_states) > self.RFM_MERGE_BATCH:
+            self._rfm_states = [merge_rfm_states(*self._rfm_states)]
+        return self
+
+    def merge(self, other):
+        """Combine another accumulator into this one."""
+        self.ticket_sum += other.ticket_sum
+        self.ticket_count += other.ticket_count
+        self.offer_counts = self._add(self.offer_counts, other.offer_counts)
+        self.revenue = self._add(self.revenue, other.revenue)
+        self._rfm_states.extend(other._rfm_states)
+        return self
+
+    @staticmethod
+    def _add(left, right):
+        if right.empty:
+            return left
+        if left.empty:
+            return right.copy()
+        return left.add(right, fill_value=0).astype(left.dtype)
+
+    def results(self, portfolio):
+        """Final KPI values; `portfolio` has id_oferta/canal columns as in calculate_channel_conversion."""
+        ticket = self.ticket_sum / self.ticket_count if self.ticket_count else float('nan')
+        rfm = rfm_from_state(self.rfm_state)
+        rfm['Segment'] = segment_rfm(rfm)
+
+        return {
+            'ticket_average': ticket,
+            'channel_conversion': channel_conversion_from_counts(self.offer_counts, portfolio),
+            'revenue_by_offer': self.revenue.sort_values(ascending=False),
+            'rfm': rfm,
+        }
+
+@instrument
+def calculate_kpis_streaming(data_dir='data/', chunksize=250_000, use_cache=True):
+    """Ticket average, channel conversion, revenue by offer and RFM without loading all events.
+
+    Peak memory is one chunk plus the accumulator tables.
+    """
+    portfolio, profile = load_dimensions(data_dir, use_cache=use_cache)
+    acc = KPIAccumulator()
+    for chunk in iter_processed_chunks(data_dir, portfolio, profile, chunksize=chunksize):
+        acc.update(chunk)
+    return acc.results(portfolio.rename(columns={'id': 'id_oferta'}))
+
+def load_rfm_state(state_path):
+    """Persisted RFM state and its metadata (watermark, source offset); empty if missing."""
+    if not os.path.exists(state_path):
+        return empty_rfm_state(), {'watermark': None, 'offset': 0, 'digest': None}
+    saved = pd.read_pickle(state_path)
+    return saved['state'], saved['meta']
+
+def save_rfm_state(state, meta, state_path):
+    """Atomically persist an RFM state with its metadata."""
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    tmp_path = state_path + '.tmp'
+    pd.to_pickle({'state': state, 'meta': meta}, tmp_path)
+    os.replace(tmp_path, state_path)
+
+@instrument
+def update_rfm_state(state, events, watermark=None):
+    """Fold new events into an RFM state.
+
+    Returns the new state and watermark (latest tempo_decorrido seen). The
+    watermark is bookkeeping only: appended events may share its timestamp,
+    so callers must pass each event once (refresh_rfm does, by byte offset).
+    """
+    if events.empty:
+        return state, watermark
+    transactions = select_events(events, ['cliente', 'tempo_decorrido', 'valor'], ['transacao'])
+    state = merge_rfm_states(state, rfm_state_from_transactions(transactions))
+    new_watermark = int(events['tempo_decorrido'].max())
+    return state, new_watermark if watermark is None else max(watermark, new_watermark)
+
+@instrument
+def refresh_rfm(data_dir='data/', state_path=None):
+    """Incrementally refreshed RFM table (scored and segmented).
+
+    Only the bytes appended to eventos_ofertas.csv since the last run are
+    parsed; quintile scoring runs on the per-customer state. A shrunk or
+    rewritten log (smaller than the stored offset, or with different bytes
+    before it, see prefix_digest) rebuilds the state from scratch.
+    """
+    e_path = f"{data_dir}eventos_ofertas.csv"
+    if state_path is None:
+        state_path = os.path.join(data_dir, CACHE_DIR_NAME, 'rfm_state.pkl')
+
+    state, meta = load_rfm_state(state_path)
+    offset = meta['offset']
+    if os.path.getsize(e_path) < offset or meta.get('digest') != prefix_digest(e_path, offset):
+        state, meta = empty_rfm_state(), {'watermark': None, 'offset': 0, 'digest': None}
+
+    events, offset = read_events_since(e_path, meta['offset'])
+    state, watermark = update_rfm_state(state, events, meta['watermark'])
+    save_rfm_state(state, {'watermark': watermark, 'offset': offset, 'digest': prefix_digest(e_path, offset)}, state_path)
+
+    rfm = rfm_from_state(state)
+    rfm['Segment'] = segment_rfm(rfm)
+    return rfm
+
+SEGMENT_DEFAULT = 'Precisa de Atencao'
+
+# Segment rules, first match wins: (segment, R_Score range, (F+M)/2 range),
+# ranges half-open [low, high)
+SEGMENT_RULES = [
+    ('Campeoes', (4, np.inf), (4, np.inf)),
+    ('Clientes Leais', (3, np.inf), (3, np.inf)),
+    ('Em Risco', (-np.inf, 3), (3, np.inf)),
+    ('Hibernando', (-np.inf, 3), (-np.inf, 3)),
+    ('Promissores', (3, np.inf), (-np.inf, 3)),
+]
+
+def _segment_codes(r, fm, rules=SEGMENT_RULES):
+    # Index of the first matching rule, len(rules) for the default segment
+    conditions = [(r >= r_lo) & (r < r_hi) & (fm >= fm_lo) & (fm < fm_hi) for _, (r_lo, r_hi), (fm_lo, fm_hi) in rules]
+    return np.select(conditions, np.arange(len(rules)), default=len(rules))
+
+def _apply_segment_rules(r, fm, rules=SEGMENT_RULES, default=SEGMENT_DEFAULT):
+    labels = np.array([segment for segment, _, _ in rules] + [default])
+    return labels[_segment_codes(r, fm, rules)]
+
+@instrument
+def segment_rfm(rfm):
+    """Vectorized segment_customer: the same rules over whole score columns."""
+    r = rfm['R_Score'].to_numpy()
+    fm = (rfm['F_Score'].to_numpy() + rfm['M_Score'].to_numpy()) / 2
+    return pd.Series(_apply_segment_rules(r, fm), index=rfm.index, name='Segment')
+
+@instrument
+def calculate_rfm_segments(df):
+    """RFM table with scores and Segment in one call."""
+    rfm = calculate_rfm(df)
+    rfm['Segment'] = segment_rfm(rfm)
+    return rfm
+
+# --- Windowed KPIs (per day/week of tempo_decorrido, or per membro_desde cohort) ---
+
+WINDOW_HOURS = {'daily': 24, 'weekly': 7 * 24}
+WINDOW_EVENT_TYPES = ['transacao', 'oferta recebida', 'oferta visualizada', 'oferta concluída']
+WINDOW_COUNTS = ['transactions', 'received', 'viewed', 'completed']
+
+def _window_keys(events, by):
+    """Integer window of each event (NaN when unknown) and the index name."""
+    if by == 'cohort':
+        return events['membro_desde'].dt.year.to_numpy(dtype=np.float64), 'cohort'
+    hours = WINDOW_HOURS.get(by, by)
+    if isinstance(hours, str) or not hours > 0:
+        raise ValueError(f"by must be 'daily', 'weekly', 'cohort' or a number of hours, got {by!r}")
+    return events['tempo_decorrido'].to_numpy(dtype=np.float64) // hours, 'window'
+
+@instrument
+def window_sums(df, by='weekly'):
+    """Additive per-window totals: event counts by type and transaction revenue.
+
+    by: 'daily' or 'weekly' windows of tempo_decorrido (window n covers hours
+    [n * width, (n + 1) * width)), a window width in hours, or 'cohort' for
+    the year of membro_desde. Every event gets an integer (window, type)
+    code and the totals are one bincount over those codes. Sums of
+    partitions can be added up (see windowed_kpis).
+    """
+    columns = ['tipo_evento', 'tempo_decorrido', 'valor'] + (['membro_desde'] if by == 'cohort' else [])
+    events = select_events(df, columns, WINDOW_EVENT_TYPES)
+    keys, name = _window_keys(events, by)
+    stage = np.select([(events['tipo_evento'] == t).to_numpy() for t in WINDOW_EVENT_TYPES], range(len(WINDOW_EVENT_TYPES)), -1)
+    valor = events['valor'].to_numpy(dtype=np.float64)
+
+    valid = ~np.isnan(keys) & (stage >= 0)
+    keys, stage, valor = keys[valid].astype(np.int64), stage[valid], valor[valid]
+    low = int(keys.min()) if len(keys) else 0
+    n_windows = int(keys.max()) - low + 1 if len(keys) else 0
+    window = keys - low
+
+    counts = np.bincount(window * len(WINDOW_COUNTS) + stage, minlength=n_windows * len(WINDOW_COUNTS))
+    is_transaction = stage == 0
+    revenue = np.bincount(window[is_transaction], weights=np.nan_to_num(valor[is_transaction]), minlength=n_windows)
+
+    sums = pd.DataFrame(counts.reshape(n_windows, len(WINDOW_COUNTS)), columns=WINDOW_COUNTS,
+                        index=pd.RangeIndex(low, low + n_windows, name=name))
+    sums.insert(1, 'revenue', revenue)
+    return sums[sums.sum(axis=1) > 0]
+
+@instrument
+def windowed_kpis(sums, rolling=None):
+    """Revenue, ticket average and conversion per window, from window_sums.
+
+    Windows with no events are filled in, so consecutive rows are
+    consecutive windows. rolling=k aggregates each window with the k - 1
+    before it (the first rows cover fewer); the rolled totals are
+    differences of cumulative sums, not one filter per window.
+    conversion_rate is completed / viewed, as in calculate_channel_conversion.
+    """
+    if len(sums):
+        sums = sums.reindex(pd.RangeIndex(sums.index.min(), sums.index.max() + 1, name=sums.index.name), fill_value=0)
+    if rolling:
+        cumulative = sums.cumsum()
+        sums = cumulative - cumulative.shift(rolling, fill_value=0)
+    stats = sums.copy()
+    stats['ticket_average'] = sums['revenue'] / sums['transactions'].where(sums['transactions'] > 0)
+    stats['conversion_rate'] = sums['completed'] / sums['viewed'].where(sums['viewed'] > 0)
+    return stats
+
+@instrument
+def calculate_windowed_kpis(df, by='weekly', rolling=None):
+    """KPIs per time window or cohort (see window_sums and windowed_kpis)."""
+    return windowed_kpis(window_sums(df, by), rolling)
+
+# --- Offer lifecycle (received -> viewed -> completed per offer instance) ---
+
+LIFECYCLE_STAGES = ['oferta recebida', 'oferta visualizada', 'oferta concluída']
+
+def _first_per_instance(instance, times, n_instances):
+    # instance ids are non-decreasing here, so the first row of a run is the earliest
+    out = np.full(n_instances, np.nan)
+    keep = instance >= 0
+    instance, times = instance[keep], times[keep]
+    first = np.ones(len(instance), dtype=bool)
+    first[1:] = instance[1:] != instance[:-1]
+    out[instance[first]] = times[first]
+    return out
+
+@instrument
+def offer_instances(df):
+    """One row per offer receipt, with the time it was viewed and completed.
+
+    Offer events are sorted once by (cliente, id_oferta, tempo_decorrido,
+    stage); each 'oferta recebida' opens an instance that owns the views and
+    completions of the same customer and offer until the next receipt.
+    Events with no earlier receipt are left out. Everything after the sort
+    is a linear pass. Columns: cliente, id_oferta, received_at, viewed_at,
+    completed_at (NaN when missing), time_to_view, time_to_complete and
+    viewed_before_completion.
+    """
+    events = select_events(df, ['cliente', 'id_oferta', 'tipo_evento', 'tempo_decorrido'], LIFECYCLE_STAGES)
+    customer, customer_ids = sorted_codes(events['cliente'])
+    offer, offer_ids = sorted_codes(events['id_oferta'])
+    stage = np.select([(events['tipo_evento'] == name).to_numpy() for name in LIFECYCLE_STAGES], [0, 1, 2], -1)
+    times = events['tempo_decorrido'].to_numpy(dtype=np.float64)
+
+    # 1. Sort by (cliente, offer, time), receipts first within a timestamp
+    valid = (customer >= 0) & (offer >= 0) & (stage >= 0)
+    order = np.flatnonzero(valid)
+    order = order[np.lexsort((stage[order], times[order], offer[order], customer[order]))]
+    customer, offer, stage, times = customer[order], offer[order], stage[order], times[order]
+
+    # 2. Instance of each event: the latest receipt of the same (cliente, offer) run
+    n = len(order)
+    position = np.arange(n)
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = (customer[1:] != customer[:-1]) | (offer[1:] != offer[:-1])
+    run_start = np.maximum.accumulate(np.where(new_run, position, 0)) if n else position
+    is_receipt = stage == 0
+    last_receipt = np.maximum.accumulate(np.where(is_receipt, position, -1)) if n else position
+    instance = np.where(last_receipt >= run_start, np.cumsum(is_receipt) - 1, -1)
+
+    # 3. Stage timestamps per instance
+    n_instances = int(is_receipt.sum())
+    received_at = times[is_receipt]
+    viewed_at = _first_per_instance(instance[stage == 1], times[stage == 1], n_instances)
+    completed_at = _first_per_instance(instance[stage == 2], times[stage == 2], n_instances)
+
+    return pd.DataFrame({
+        'cliente': customer_ids[customer[is_receipt]],
+        'id_oferta': offer_ids[offer[is_receipt]],
+        'received_at': received_at,
+        'viewed_at': viewed_at,
+        'completed_at': completed_at,
+        'time_to_view': viewed_at - received_at,
+        'time_to_complete': completed_at - received_at,
+        'viewed_before_completion': viewed_at <= completed_at,
+    })
+
+@instrument
+def lifecycle_counts(instances):
+    """Additive per-offer lifecycle totals (mergeable across partitions)."""
+    viewed = instances['viewed_at'].notna()
+    completed = instances['completed_at'].notna()
+    counts = pd.DataFrame({
+        'id_oferta': instances['id_oferta'].astype(object),
+        'received': 1,
+        'viewed': viewed.astype(np.int64),
+        'completed': completed.astype(np.int64),
+        'completed_after_view': instances['viewed_before_completion'].astype(np.int64),
+        'time_to_view_sum': instances['time_to_view'].fillna(0),
+        'time_to_complete_sum': instances['time_to_complete'].fillna(0),
+    })
+    return counts.groupby('id_oferta').sum()
+
+def _lifecycle_rates(counts):
+    stats = counts[['received', 'viewed', 'completed', 'completed_after_view']].copy()
+    stats['view_rate'] = stats['viewed'] / stats['received']
+    stats['completion_rate'] = stats['completed'] / stats['received']
+    stats['viewed_completion_rate'] = stats['completed_after_view'] / stats['viewed']
+    stats['mean_time_to_view'] = counts['time_to_view_sum'] / stats['viewed']
+    stats['mean_time_to_complete'] = counts['time_to_complete_sum'] / stats['completed']
+    return stats
+
+@instrument
+def lifecycle_by_offer(counts, portfolio=None):
+    """Per-offer funnel rates and mean hours to view/complete, from lifecycle_counts."""
+    stats = _lifecycle_rates(counts)
+    if portfolio is not None:
+        names = portfolio.set_index(portfolio['id_oferta'].astype(object))['oferta']
+        stats.insert(0, 'oferta', names.reindex(stats.index).to_numpy())
+    return stats.sort_values('completion_rate', ascending=False, kind='stable')
+
+@instrument
+def lifecycle_by_channel(counts, portfolio):
+    """Per-channel funnel rates (an instance counts for every channel of its offer)."""
+    totals = offer_channel_index(portfolio).channel_counts(counts)
+    totals = totals[totals['received'] > 0]
+    return _lifecycle_rates(totals).sort_values('completion_rate', ascending=False, kind='stable')
+
+# --- Per-customer lookups (through the customer index, no full scans) ---
+
+@instrument
+def customer_timeline(df, cliente, columns=None):
+    """All events of one customer, in event order."""
+    if isinstance(df, EventPartitions):
+        df = df.source
+    return customer_index(df).select(df, cliente, columns)
+
+@instrument
+def customer_offer_history(df, cliente):
+    """Offer events (received, viewed, completed) of one customer."""
+    timeline = customer_timeline(df, cliente, ['tempo_decorrido', 'tipo_evento', 'id_oferta', 'oferta'])
+    return timeline[timeline['tipo_evento'] != 'transacao']
+
+@instrument
+def customer_rfm_state(df, cliente):
+    """One-row RFM state of a customer (see RFMModel.score_state)."""
+    transactions = customer_timeline(df, cliente, ['cliente', 'tipo_evento', 'tempo_decorrido', 'valor'])
+    transactions = transactions[transactions['tipo_evento'] == 'transacao']
+    if transactions.empty:
+        return empty_rfm_state()
+    return rfm_state_from_transactions(transactions[['cliente', 'tempo_decorrido', 'valor']])
+
+RFM_MEASURES = ('Recency', 'Frequency', 'Monetary')
+QUINTILES = [0.2, 0.4, 0.6, 0.8]
+
+def _quintile_edges(values, by_rank=False):
+    """The 4 inner pd.qcut(..., 5) edges, in value space, and their tie-break ids.
+
+    by_rank matches score_rfm's qcut over rank(method='first'), where equal
+    values are ranked by customer order (the sorted cliente index): each
+    edge is the (value, cliente) of the last customer of a quintile.
+    """
+    if not by_rank:
+        return np.quantile(values.to_numpy(dtype=np.float64), QUINTILES), None
+    order = np.argsort(values.to_numpy(dtype=np.float64), kind='stable')
+    last = order[_rank_targets(len(values), QUINTILES) - 1]
+    return values.to_numpy(dtype=np.float64)[last], values.index[last].to_numpy()
+
+def _rank_targets(n, quantiles):
+    # 1-based ranks of the last item of each pd.qcut bin over rank(method='first')
+    return np.maximum(np.floor(np.quantile(np.arange(1, n + 1), quantiles)).astype(np.int64), 1)
+
+def _rank_scores(edges, ids, values, cliente=None):
+    # 1 + edges below each value; on a tied edge value the cliente id decides
+    scores = 1 + np.searchsorted(edges, values, side='left')
+    if ids is not None and cliente is not None:
+        cliente = np.asarray(cliente)
+        for edge, edge_id in zip(edges, ids):
+            scores = scores + ((values == edge) & (cliente > edge_id))
+    return scores
+
+class RFMModel:
+    """R/F/M quintile edges and segment rules, fitted once on a population.
+
+    Scoring is a searchsorted per measure against the stored edges, so new
+    customers (one or a batch) are segmented without the full dataset.
+    score_rfm splits F/M ties by customer order; the model stores the
+    cliente at each edge and does the same when given ids, so scoring the
+    fitted population reproduces score_rfm exactly. Without ids a value
+    tied with an edge gets the lower score.
+    """
+
+    def __init__(self, edges, rules=SEGMENT_RULES, default=SEGMENT_DEFAULT, reference_time=None, edge_ids=None):
+        self.edges = {m: np.asarray(edges[m], dtype=np.float64) for m in RFM_MEASURES}
+        self.edge_ids = {m: np.asarray(ids) for m, ids in (edge_ids or {}).items()}
+        self.rules = [(segment, tuple(r), tuple(fm)) for segment, r, fm in rules]
+        self.default = default
+        # Time Recency was measured from at fit time (see score_state)
+        self.reference_time = reference_time
+
+    def score_values(self, recency, frequency, monetary, cliente=None):
+        """(R, F, M, Segment) arrays for scalars or arrays of raw measures."""
+        r = 5 - np.searchsorted(self.edges['Recency'], recency, side='left')
+        f = _rank_scores(self.edges['Frequency'], self.edge_ids.get('Frequency'), np.asarray(frequency, dtype=np.float64), cliente)
+        m = _rank_scores(self.edges['Monetary'], self.edge_ids.get('Monetary'), np.asarray(monetary, dtype=np.float64), cliente)
+        return r, f, m, _apply_segment_rules(r, (f + m) / 2, self.rules, self.default)
+
+    def segment(self, recency, frequency, monetary, cliente=None):
+        """Segment of a single customer."""
+        return str(self.score_values(recency, frequency, monetary, cliente)[3])
+
+    def score(self, rfm):
+        """rfm (Recency/Frequency/Monetary columns, indexed by cliente) with the scores and Segment added."""
+        measures = [rfm[c].to_numpy() for c in RFM_MEASURES]
+        r, f, m, segments = self.score_values(*measures, cliente=rfm.index.to_numpy())
+        scored = rfm.copy()
+        scored['R_Score'], scored['F_Score'], scored['M_Score'] = r, f, m
+        scored['Segment'] = segments
+        return scored
+
+    def score_state(self, state, max_time=None):
+        """Scores an RFM state (see rfm_state_from_transactions).
+
+        Recency is measured from max_time, by default the fit's reference time.
+        """
+        max_time = self.reference_time if max_time is None else max_time
+        if max_time is None:
+            raise ValueError("max_time is required: the model has no reference time")
+        rfm = pd.DataFrame({
+            'Recency': max_time - state['last_time'],
+            'Frequency': state['Frequency'],
+            'Monetary': state['Monetary'],
+        })
+        return self.score(rfm)
+
+    def to_dict(self):
+        return {
+            'edges': {m: self.edges[m].tolist() for m in RFM_MEASURES},
+            'edge_ids': {m: ids.tolist() for m, ids in self.edge_ids.items()},
+            'rules': [[segment, list(r), list(fm)] for segment, r, fm in self.rules],
+            'default': self.default,
+            'reference_time': self.reference_time,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['edges'], data['rules'], data['default'], data['reference_time'], data.get('edge_ids'))
+
+@instrument
+def fit_rfm_model(rfm, reference_time=None):
+    """RFMModel with the quintile edges score_rfm would use on `rfm` (indexed by cliente, sorted)."""
+    edges, edge_ids = {}, {}
+    for measure in RFM_MEASURES:
+        edges[measure], ids = _quintile_edges(rfm[measure], by_rank=measure != 'Recency')
+        if ids is not None:
+            edge_ids[measure] = ids
+    if reference_time is not None:
+        reference_time = float(reference_time)
+    return RFMModel(edges, reference_time=reference_time, edge_ids=edge_ids)
+
+def save_rfm_model(model, model_path):
+    """Atomically write an RFMModel as JSON."""
+    os.makedirs(os.path.dirname(os.path.abspath(model_path)), exist_ok=True)
+    tmp_path = model_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(model.to_dict(), f, indent=2)
+    os.replace(tmp_path, model_path)
+
+def load_rfm_model(model_path):
+    with open(model_path) as f:
+        return RFMModel.from_dict(json.load(f))
+
+# --- Approximate RFM quintiles from mergeable sketches ---
+
+RFM_SKETCH_EPS = 0.001
+
+def _ceil_ranks(n, size):
+    # ceil(j * n / size) for j = 1..size, in integers
+    return -(-np.arange(1, size + 1, dtype=np.int64) * n // size)
+
+class QuantileSketch:
+    """Mergeable rank summary of a column, for approximate quantiles.
+
+    Keeps a sorted subset of the items (points) and, for each, the number
+    of items since the previous point (weights), so a point's cumulative
+    weight is its rank. from_values keeps about 1 / eps evenly spaced ranks
+    of a partition (plus its minimum); merge() combines partitions. An item
+    looked up by rank is at most eps * n ranks (+1 per merged partition)
+    from the exact one, however many partitions are merged. Items can carry
+    an id that breaks value ties (order: value, then id), as score_rfm's
+    rank-based quintiles do.
+    """
+
+    def __init__(self, values, weights, ids=None, eps=RFM_SKETCH_EPS):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.int64)
+        self.ids = None if ids is None else np.asarray(ids)
+        self.eps = eps
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def n(self):
+        return int(self.weights.sum())
+
+    @classmethod
+    def from_values(cls, values, eps=RFM_SKETCH_EPS, ids=None):
+        """Sketch of `values`; with ids, values must be in id order (e.g. a table sorted by cliente)."""
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(values, kind='stable')
+        ranks = np.unique(np.concatenate([[1], _ceil_ranks(len(values), math.ceil(1 / eps))])) if len(values) else np.array([], dtype=np.int64)
+        picks = order[ranks - 1]
+        return cls(values[picks], np.diff(ranks, prepend=0), None if ids is None else np.asarray(ids)[picks], eps)
+
+    @classmethod
+    def merge(cls, sketches):
+        """One sketch over the items of all `sketches` (no extra error)."""
+        sketches = list(sketches)
+        eps = max(s.eps for s in sketches)
+        sketches = [s for s in sketches if len(s)]
+        if not sketches:
+            return cls([], [], eps=eps)
+        values = np.concatenate([s.values for s in sketches])
+        weights = np.concatenate([s.weights for s in sketches])
+        if all(s.ids is not None for s in sketches):
+            ids = np.concatenate([s.ids for s in sketches])
+            # lexsort needs a fixed-width dtype; there are only a few points
+            order = np.lexsort((ids.astype(str) if ids.dtype == object else ids, values))
+            ids = ids[order]
+        else:
+            order, ids = np.argsort(values, kind='stable'), None
+        return cls(values[order], weights[order], ids, eps)
+
+    def items(self, ranks):
+        """(values, ids) of the items at 1-based `ranks`, approximately."""
+        index = np.searchsorted(np.cumsum(self.weights), ranks, side='left')
+        index = np.minimum(index, len(self) - 1)
+        return self.values[index], None if self.ids is None else self.ids[index]
+
+    def quantile(self, q):
+        """np.quantile (linear interpolation) of the sketched column."""
+        h = (self.n - 1) * np.asarray(q, dtype=np.float64)
+        lower, _ = self.items(np.floor(h).astype(np.int64) + 1)
+        upper, _ = self.items(np.ceil(h).astype(np.int64) + 1)
+        return lower + (h - np.floor(h)) * (upper - lower)
+
+    def rank_edges(self, q):
+        """(value, id) of the last item of each pd.qcut bin over rank(method='first')."""
+        return self.items(_rank_targets(self.n, q))
+
+@instrument
+def rfm_state_sketches(state, eps=RFM_SKETCH_EPS):
+    """Quantile sketches of one partition's RFM state (see rfm_state_from_transactions).
+
+    Recency = max_time - last_time needs the latest purchase of all
+    partitions, so -last_time is sketched instead (Recency minus max_time,
+    same order). F and M carry the cliente, for score_rfm's tie order.
+    """
+    state = state.sort_index()
+    ids = state.index.to_numpy()
+    return {
+        'Recency': QuantileSketch.from_values(-state['last_time'].to_numpy(dtype=np.float64), eps),
+        'Frequency': QuantileSketch.from_values(state['Frequency'], eps, ids),
+        'Monetary': QuantileSketch.from_values(state['Monetary'], eps, ids),
+    }
+
+@instrument
+def merge_rfm_sketches(sketches):
+    """Combines the rfm_state_sketches of several partitions."""
+    return {measure: QuantileSketch.merge([s[measure] for s in sketches]) for measure in RFM_MEASURES}
+
+@instrument
+def fit_rfm_model_from_sketches(sketches, max_time=None):
+    """RFMModel with quintile edges from (merged) rfm_state_sketches.
+
+    max_time defaults to the latest purchase, which the sketches keep
+    exactly. With sketches that kept every item the edges are
+    fit_rfm_model's; otherwise each edge is within eps * n ranks.
+    """
+    recency = sketches['Recency']
+    if max_time is None:
+        max_time = -recency.values[0]
+    edges = {'Recency': max_time + recency.quantile(QUINTILES)}
+    edge_ids = {}
+    for measure in ('Frequency', 'Monetary'):
+        edges[measure], edge_ids[measure] = sketches[measure].rank_edges(QUINTILES)
+    return RFMModel(edges, reference_time=float(max_time), edge_ids=edge_ids)
+
+def _score_partition(model, state):
+    return model.score_state(state.sort_index())
+
+def _map_partitions(pool, func, states):
+    # pool.map that keeps the workers' instrumentation records
+    results = []
+    for result, worker_records in pool.map(collected(func), states):
+        results.append(result)
+        absorb(worker_records)
+    return results
+
+@instrument
+def score_rfm_partitions(states, eps=RFM_SKETCH_EPS, workers=1):
+    """Scores customer partitions separately, from their combined sketches.
+
+    Only the sketches (about 3 / eps points per partition) are brought
+    together; each partition is then scored on its own by the fitted model
+    (R/F/M scores and Segment). With workers > 1 the sketching and scoring
+    of the partitions run in a process pool (each state is sent to a worker
+    twice). Returns the model and the scored partitions.
+    """
+    sketch = functools.partial(rfm_state_sketches, eps=eps)
+    if workers == 1:
+        model = fit_rfm_model_from_sketches(merge_rfm_sketches([sketch(state) for state in states]))
+        return model, [_score_partition(model, state) for state in states]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        model = fit_rfm_model_from_sketches(merge_rfm_sketches(_map_partitions(pool, sketch, states)))
+        return model, _map_partitions(pool, functools.partial(_score_partition, model), states)
+
+# --- Segmentation scenarios (many scorings of one RFM base) ---
+
+# A scenario overrides any of these: score bins per measure, segment rules
+# (thresholds in that score scale) and the Monetary it ranks on (None:
+# every transaction; else an attribute_revenue (window, credit) pair)
+RFM_SCENARIO_DEFAULTS = {'bins': 5, 'rules': SEGMENT_RULES, 'default': SEGMENT_DEFAULT, 'attribution': None}
+
+RFM_SCENARIOS = {
+    'baseline': {},
+    'quartiles': {'bins': 4, 'rules': [
+        ('Campeoes', (4, np.inf), (3.5, np.inf)),
+        ('Clientes Leais', (3, np.inf), (2.5, np.inf)),
+        ('Em Risco', (-np.inf, 3), (2.5, np.inf)),
+        ('Hibernando', (-np.inf, 3), (-np.inf, 2.5)),
+        ('Promissores', (3, np.inf), (-np.inf, 2.5)),
+    ]},
+    'strict_champions': {'rules': [('Campeoes', (5, np.inf), (4.5, np.inf))] + SEGMENT_RULES[1:]},
+    'offer_revenue': {'attribution': ('duracao', 'last')},
+}
+
+def rfm_scenarios(scenarios=RFM_SCENARIOS):
+    """Scenarios with every field filled in (attribution as a tuple, e.g. after JSON)."""
+    full = {}
+    for name, overrides in scenarios.items():
+        unknown = set(overrides) - set(RFM_SCENARIO_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Scenario '{name}' has unknown fields: {sorted(unknown)}")
+        scenario = {**RFM_SCENARIO_DEFAULTS, **overrides}
+        scenario['rules'] = [(segment, tuple(r), tuple(fm)) for segment, r, fm in scenario['rules']]
+        if scenario['attribution'] is not None:
+            scenario['attribution'] = tuple(scenario['attribution'])
+        full[name] = scenario
+    return full
+
+def rfm_scenario_attributions(scenarios=RFM_SCENARIOS):
+    """Distinct attributions the scenarios need in rfm_base, in first-use order."""
+    attributions = [s['attribution'] for s in rfm_scenarios(scenarios).values() if s['attribution'] is not None]
+    return list(dict.fromkeys(attributions))
+
+def _bin_scores(values, bins):
+    # pd.qcut(values, bins) bin numbers (1..bins): 1 + inner edges below each value
+    edges = np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1])
+    return 1 + np.searchsorted(edges, values, side='left')
+
+def _scenario_codes(base, scenarios):
+    """(name, scenario, segment codes, segment labels) per scenario.
+
+    Ranks are taken once per measure column and scores once per (column,
+    bins), then shared by every scenario that uses them; segmenting is one
+    vectorized rule pass per scenario.
+    """
+    @functools.cache
+    def ranks(column):
+        # rank(method='first') over the cliente-sorted base, as in score_rfm
+        ranked = np.empty(len(base), dtype=np.float64)
+        ranked[np.argsort(base[column].to_numpy(dtype=np.float64), kind='stable')] = np.arange(1, len(base) + 1)
+        return ranked
+
+    @functools.cache
+    def scores(column, bins):
+        if column == 'Recency':
+            return bins + 1 - _bin_scores(base['Recency'].to_numpy(dtype=np.float64), bins)
+        return _bin_scores(ranks(column), bins)
+
+    for name, scenario in rfm_scenarios(scenarios).items():
+        bins, rules = scenario['bins'], scenario['rules']
+        r = scores('Recency', bins)
+        fm = (scores('Frequency', bins) + scores(rfm_monetary_column(scenario['attribution']), bins)) / 2
+        labels = [segment for segment, _, _ in rules] + [scenario['default']]
+        yield name, scenario, _segment_codes(r, fm, rules), labels
+
+@instrument
+def segment_rfm_scenarios(base, scenarios=RFM_SCENARIOS):
+    """Segment of every customer under each scenario, one column per scenario.
+
+    base is an rfm_base with the scenarios' attributions. The 'baseline'
+    scenario (defaults) reproduces calculate_rfm_segments.
+    """
+    segments = {name: np.asarray(labels)[codes] for name, _, codes, labels in _scenario_codes(base, scenarios)}
+    return pd.DataFrame(segments, index=base.index)
+
+@instrument
+def compare_rfm_scenarios(base, scenarios=RFM_SCENARIOS):
+    """Segment sizes and mean Monetary of every scenario, from one RFM base.
+
+    One row per (scenario, Segment): customers, share of customers and
+    mean_monetary, the mean of the Monetary the scenario ranks on.
+    """
+    rows = []
+    for name, scenario, codes, labels in _scenario_codes(base, scenarios):
+        monetary = base[rfm_monetary_column(scenario['attribution'])].to_numpy(dtype=np.float64)
+        counts = np.bincount(codes, minlength=len(labels))
+        sums = np.bincount(codes, weights=monetary, minlength=len(labels))
+        # Rules may share a segment name; sum them into one row
+        table = pd.DataFrame({'Segment': labels, 'customers': counts, 'monetary': sums})
+        table = table.groupby('Segment', sort=False).sum()
+        table = table[table['customers'] > 0]
+        rows.append(pd.DataFrame({
+            'scenario': name,
+            'Segment': table.index,
+            'customers': table['customers'].to_numpy(),
+            'share': table['customers'].to_numpy() / len(base),
+            'mean_monetary': table['monetary'].to_numpy() / table['customers'].to_numpy(),
+        }))
+    return pd.concat(rows, ignore_index=True).set_index(['scenario', 'Segment'])
+
+FUNNEL_EVENT_TYPES = ['oferta visualizada', 'oferta concluída']
+CHANNEL_EVENT_TYPES = ['oferta visualizada', 'oferta concluída', 'oferta recebida']
+
+@instrument
+def customer_demographics(df):
+    """One row per customer with events: cliente, idade, genero."""
+    if isinstance(df, EventPartitions):
+        df = df.source
+    if isinstance(df, LazyDataset):
+        df = df.select(['cliente', 'idade', 'genero']).collect()
+    if isinstance(df, StarSchema):
+        customers = df.customers_with_events()[['cliente', 'idade', 'genero']]
+    else:
+        # First event of each customer, from the customer index
+        customers = df[['cliente', 'idade', 'genero']].take(customer_index(df).first_rows())
+    return customers.reset_index(drop=True)
+
+@instrument
+def funnel_counts(df):
+    """Viewed/completed events per offer, long format (oferta, tipo_evento, contagem)."""
+    events = select_events(df, ['oferta', 'tipo_evento'], FUNNEL_EVENT_TYPES)
+    return events.groupby(['oferta', 'tipo_evento'], observed=True).size().reset_index(name='contagem')
+
+@instrument
+def channel_counts(df, portfolio):
+    """Offer events per channel, long format (canal_individual, tipo_evento, contagem)."""
+    return _long_channel_counts(channel_event_counts(df, portfolio, CHANNEL_EVENT_TYPES))
+
+def _long_channel_counts(stats):
+    return stats.stack().rename('contagem').reset_index()
+
+# Small tables the charts are drawn from, so rendering never scans events
+PLOT_TABLES = ('demographics', 'funnel_counts', 'channel_counts')
+
+# Per-offer / per-channel funnel from the offer instances (see offer_instances)
+LIFECYCLE_TABLES = ('offer_lifecycle', 'channel_lifecycle')
+
+KPI_METRICS = ('ticket_average', 'channel_conversion', 'revenue_by_offer', 'rfm')
+
+@instrument
+def compute_all_kpis(df, portfolio, window='exact', credit='all', metrics=KPI_METRICS):
+    """Every KPI from one partitioning of the events by type.
+
+    Returns the same keys as KPIAccumulator.results: ticket_average,
+    channel_conversion, revenue_by_offer and rfm (scored and segmented),
+    or the subset named in `metrics`, which may also name PLOT_TABLES,
+    LIFECYCLE_TABLES and 'weekly_kpis'. window/credit configure revenue
+    attribution (see attribute_revenue).
+    """
+    # A LazyDataset is not partitioned: each KPI reads only its own rows and columns
+    parts = df if isinstance(df, (EventPartitions, LazyDataset)) else EventPartitions(df)
+    compute = {
+        'ticket_average': lambda: calculate_ticket_average(parts),
+        'channel_conversion': lambda: calculate_channel_conversion(parts, portfolio),
+        'revenue_by_offer': lambda: calculate_revenue_by_offer(parts, window=window, credit=credit),
+        'rfm': lambda: calculate_rfm_segments(parts),
+        'demographics': lambda: customer_demographics(parts),
+        'funnel_counts': lambda: funnel_counts(parts),
+        'channel_counts': lambda: channel_counts(parts, portfolio),
+        'weekly_kpis': lambda: calculate_windowed_kpis(parts, 'weekly'),
+        'offer_lifecycle': lambda: lifecycle_by_offer(lifecycle(), portfolio),
+        'channel_lifecycle': lambda: lifecycle_by_channel(lifecycle(), portfolio),
+    }
+    # Both lifecycle tables come from one sessionization pass
+    lifecycle = functools.cache(lambda: lifecycle_counts(offer_instances(parts)))
+    return {name: compute[name]() for name in metrics}
+
+PARALLEL_COLUMNS = ['cliente', 'tipo_evento', 'tempo_decorrido', 'id_oferta', 'oferta', 'duracao', 'valor']
+
+@instrument
+def _customer_partition_kpis(events, window='exact', credit='all', metrics=KPI_METRICS):
+    """Partial aggregates of one customer partition (runs in a worker process)."""
+    parts = EventPartitions(events)
+    partial = {}
+    if 'rfm' in metrics:
+        trans = select_events(parts, ['cliente', 'tempo_decorrido', 'valor'], ['transacao'])
+        partial['rfm_state'] = rfm_state_from_transactions(trans)
+    if 'revenue_by_offer' in metrics:
+        partial['attributed'] = attribute_revenue(parts, window=window, credit=credit)
+    if 'channel_conversion' in metrics or 'channel_counts' in metrics:
+        relevant = select_events(parts, ['id_oferta', 'tipo_evento'], CHANNEL_EVENT_TYPES)
+        partial['offer_counts'] = relevant.groupby(['id_oferta', 'tipo_evento'], observed=True).size()
+    if 'funnel_counts' in metrics:
+        partial['funnel_counts'] = funnel_counts(parts)
+    if any(name in metrics for name in LIFECYCLE_TABLES):
+        partial['lifecycle_counts'] = lifecycle_counts(offer_instances(parts))
+    if 'weekly_kpis' in metrics:
+        partial['window_sums'] = window_sums(parts, 'weekly')
+    return partial
+
+@instrument
+def customer_partitions(df, n_partitions):
+    """Row positions of each hash partition of the events by customer.
+
+    Partition = integer customer code modulo n_partitions; rows keep their
+    original order inside a partition.
+    """
+    if isinstance(df, StarSchema):
+        codes = df.facts['cliente_key'].to_numpy()
+    elif isinstance(df['cliente'].dtype, pd.CategoricalDtype):
+        codes = df['cliente'].cat.codes.to_numpy()
+    else:
+        codes, _ = pd.factorize(df['cliente'])
+    part = codes.astype(np.int64) % n_partitions
+    order = np.argsort(part, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(part, minlength=n_partitions))[:-1])
+
+@instrument
+def compute_all_kpis_parallel(df, portfolio, workers=None, window='exact', credit='all', metrics=KPI_METRICS):
+    """compute_all_kpis over a process pool, hash-partitioned by customer.
+
+    Workers return per-customer RFM state, attributed revenue pairs and
+    per-offer/funnel/lifecycle/window counts; the merge is exact because
+    every customer lives in one partition and attributed pairs are
+    re-sorted into transaction order before summing. Results are identical to the serial path.
+    """
+    workers = workers or os.cpu_count() or 1
+    if isinstance(df, EventPartitions):
+        df = df.source
+    columns = [c for c in PARALLEL_COLUMNS if c != 'duracao' or window == 'duracao']
+    if isinstance(df, LazyDataset):
+        # One read of what the partitions and the serial merges use
+        df = df.select(columns + ['idade', 'genero']).collect()
+    events = select_events(df, columns)
+    partitions = [events.take(rows) for rows in customer_partitions(df, workers)]
+
+    task = functools.partial(_customer_partition_kpis, window=window, credit=credit, metrics=metrics)
+    if workers == 1:
+        partials = [task(part) for part in partitions]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = []
+            for partial, worker_records in pool.map(collected(task), partitions):
+                partials.append(partial)
+                absorb(worker_records)
+
+    # Merge: customers are disjoint across partitions
+    results = {}
+    for name in metrics:
+        if name == 'ticket_average':
+            results[name] = calculate_ticket_average(df)
+        elif name in ('channel_conversion', 'channel_counts'):
+            offer_counts = pd.concat([p['offer_counts'] for p in partials])
+            offer_counts = offer_counts.groupby(level=[0, 1], observed=True).sum()
+            if name == 'channel_counts':
+                results[name] = _long_channel_counts(_channel_counts_from_offer_counts(offer_counts, portfolio))
+            else:
+                viewed_or_completed = offer_counts.index.get_level_values('tipo_evento').isin(FUNNEL_EVENT_TYPES)
+                results[name] = channel_conversion_from_counts(offer_counts[viewed_or_completed], portfolio)
+        elif name == 'funnel_counts':
+            counts = pd.concat([p['funnel_counts'] for p in partials])
+            results[name] = counts.groupby(['oferta', 'tipo_evento'], observed=True)['contagem'].sum().reset_index()
+        elif name == 'demographics':
+            results[name] = customer_demographics(df)
+        elif name == 'revenue_by_offer':
+            attributed = pd.concat([p['attributed'] for p in partials]).sort_index(kind='stable')
+            results[name] = attributed.groupby('oferta', observed=True)['valor'].sum().sort_values(ascending=False)
+        elif name == 'rfm':
+            rfm = rfm_from_state(pd.concat([p['rfm_state'] for p in partials]))
+            rfm['Segment'] = segment_rfm(rfm)
+            results[name] = rfm
+        elif name in LIFECYCLE_TABLES:
+            counts = pd.concat([p['lifecycle_counts'] for p in partials]).groupby(level=0).sum()
+            by = lifecycle_by_offer if name == 'offer_lifecycle' else lifecycle_by_channel
+            results[name] = by(counts, portfolio)
+        elif name == 'weekly_kpis':
+            sums = pd.concat([p['window_sums'] for p in partials]).groupby(level=0).sum()
+            results[name] = windowed_kpis(sums)
+    return results
+
 def segment_customer(row):
     """Apply segmentation logic."""
     r = row['R_Score']
@@ -0,0 +1,198 @@
+from concurrent.futures import Future
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+
+from src import instrumentation
+from src.data_loader import file_sha1
+
+class Stage:
+    """One pipeline step: func(*input values, **params, **options).
+
+    inputs are upstream stage names, sources are files read directly and
+    outputs files the stage writes (its checkpoint only holds the return
+    value, so the stage is not current while one is missing). params feed
+    the checkpoint key; options (e.g. worker counts) do not, because they
+    must not change the result.
+    """
+
+    def __init__(self, name, func, inputs=(), params=(), options=(), sources=(), checkpoint=True, outputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+        self.options = tuple(options)
+        self.sources = tuple(sources)
+        self.checkpoint = checkpoint
+        self.outputs = tuple(outputs)
+
+def _code_fingerprint(func):
+    if isinstance(func, functools.partial):
+        # Stages bound with partial (e.g. one generic renderer per figure)
+        bound = repr((func.args, sorted(func.keywords.items())))
+        return hashlib.sha1((_code_fingerprint(func.func) + bound).encode()).hexdigest()
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = f"{func.__module__}.{func.__qualname__}"
+    return hashlib.sha1(source.encode()).hexdigest()
+
+class Pipeline:
+    """Small DAG runner with on-disk checkpoints.
+
+    A stage's key hashes its code, its params, the content of its source
+    files and the keys of its inputs, so keys are known before anything
+    runs. run() executes a stage only when no checkpoint matches its key,
+    and loads upstream checkpoints only when a downstream stage needs them.
+    """
+
+    def __init__(self, checkpoint_dir, params=None, code_files=()):
+        self.checkpoint_dir = checkpoint_dir
+        self.params = dict(params or {})
+        # Library modules the stages call into; editing them invalidates every stage
+        self.code_files = tuple(sorted(code_files))
+        self.stages = {}
+        self.status = {}
+        self._keys = {}
+        self._values = {}
+        self._library = None
+
+    def add(self, name, func, inputs=(), params=(), options=(), sources=(), checkpoint=True, outputs=()):
+        """Declare a stage; its inputs must already be declared."""
+        missing = [i for i in inputs if i not in self.stages]
+        if missing:
+            raise ValueError(f"Stage '{name}' depends on undeclared stages: {missing}")
+        self.stages[name] = Stage(name, func, inputs, params, options, sources, checkpoint, outputs)
+        return self
+
+    def key(self, name):
+        """Checkpoint key of a stage (hash of code, params, sources and input keys)."""
+        if name not in self._keys:
+            stage = self.stages[name]
+            sources = []
+            for path in stage.sources:
+                # Content, not mtime: a touched or re-checked-out file keeps its checkpoints
+                sources.append([os.path.abspath(path), file_sha1(path, self.checkpoint_dir)])
+            payload = {
+                'name': name,
+                'code': _code_fingerprint(stage.func),
+                'library': self._library_fingerprint(),
+                'params': {p: self.params.get(p) for p in stage.params},
+                'sources': sources,
+                'inputs': [self.key(i) for i in stage.inputs],
+            }
+            encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+            self._keys[name] = hashlib.sha1(encoded).hexdigest()[:16]
+        return self._keys[name]
+
+    def _library_fingerprint(self):
+        if self._library is None:
+            digest = hashlib.sha1()
+            for path in self.code_files:
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+            self._library = digest.hexdigest()
+        return self._library
+
+    def _checkpoint_path(self, name):
+        return os.path.join(self.checkpoint_dir, f"{name}-{self.key(name)}.pkl")
+
+    def is_current(self, name):
+        """True when a checkpoint matching the stage's current key and all its output files exist."""
+        stage = self.stages[name]
+        return stage.checkpoint and os.path.exists(self._checkpoint_path(name)) and not self.missing_outputs(name)
+
+    def missing_outputs(self, name):
+        """Declared output files of a stage that do not exist."""
+        return [path for path in self.stages[name].outputs if not os.path.exists(path)]
+
+    def _save(self, name, value):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = self._checkpoint_path(name)
+        tmp_path = path + '.tmp'
+        pd.to_pickle(value, tmp_path)
+        os.replace(tmp_path, path)
+        # Drop checkpoints of older keys for this stage
+        for old in glob.glob(os.path.join(self.checkpoint_dir, f"{name}-*.pkl")):
+            if old != path:
+                os.remove(old)
+
+    def value(self, name, force=()):
+        """Output of a stage: from memory, its checkpoint, or by running it."""
+        if name in self._values:
+            return self._values[name]
+
+        if name not in force and self.is_current(name):
+            value = pd.read_pickle(self._checkpoint_path(name))
+            self.status[name] = 'cached'
+        else:
+            stage = self.stages[name]
+            args, kwargs = self._arguments(stage, force)
+            with instrumentation.profile_block(f"stage:{name}", instrumentation.row_count(args)) as info:
+                value = stage.func(*args, **kwargs)
+                info['rows_out'] = instrumentation.row_count(value)
+            self._finish(name, value)
+
+        self._values[name] = value
+        return value
+
+    def _arguments(self, stage, force):
+        args = [self.value(i, force) for i in stage.inputs]
+        kwargs = {p: self.params.get(p) for p in stage.params + stage.options}
+        return args, kwargs
+
+    def _finish(self, name, value):
+        if self.stages[name].checkpoint:
+            self._save(name, value)
+        self.status[name] = 'ran'
+        self._values[name] = value
+
+    def submit(self, name, executor, force=()):
+        """Like value(), but runs the stage itself on `executor`; returns a Future.
+
+        Inputs are resolved here first, so the stage function and its
+        arguments must be picklable for a process pool. The checkpoint is
+        written when the future completes; a current stage resolves at once.
+        """
+        if name in self._values or (name not in force and self.is_current(name)):
+            future = Future()
+            future.set_result(self.value(name, force))
+            return future
+
+        stage = self.stages[name]
+        args, kwargs = self._arguments(stage, force)
+        result = Future()
+
+        # Resolve `result` only after the checkpoint is written
+        def finish(done):
+            try:
+                value, worker_records = done.result()
+                instrumentation.absorb(worker_records)
+                self._finish(name, value)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                result.set_result(value)
+        executor.submit(instrumentation.collected(stage.func, f"stage:{name}"), *args, **kwargs).add_done_callback(finish)
+        return result
+
+    def leaves(self):
+        """Stages no other stage depends on."""
+        used = {i for stage in self.stages.values() for i in stage.inputs}
+        return [name for name in self.stages if name not in used]
+
+    def run(self, targets=None, force=()):
+        """Bring `targets` (default: the leaves) up to date; returns their outputs.
+
+        force lists stages to rerun even when their checkpoint is current
+        ('all' reruns everything). Stages downstream of a forced one keep
+        their checkpoints, since their keys do not change.
+        """
+        targets = self.leaves() if targets is None else list(targets)
+        force = set(self.stages) if force == 'all' else set(force)
+        return {name: self.value(name, force) for name in targets}
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+FILE_NAMES = {
+    'portfolio': 'portfolio_ofertas.csv',
+    'events': 'eventos_ofertas.csv',
+    'profile': 'dados_clientes.csv',
+}
+
+def _read_source(source_dir):
+    read = lambda name: pd.read_csv(os.path.join(source_dir, FILE_NAMES[name]), encoding='latin-1', index_col=0)
+    return read('portfolio'), read('events'), read('profile')
+
+def _random_ids(rng, n):
+    """n random 32-character hex ids, like the source uuids."""
+    digits = rng.integers(0, 16, size=(n, 32), dtype=np.uint8)
+    chars = np.array(list('0123456789abcdef'))[digits]
+    return chars.view('<U32').ravel()
+
+def generate_dataset(scale=1, seed=0, source_dir='data/'):
+    """Synthetic (portfolio, events, profile) with the source files' schema.
+
+    Customers are drawn with replacement from the source profile and each
+    one gets a copy of the drawn customer's whole event history under a new
+    id, so demographics, funnel shapes, timings and spend keep their joint
+    distributions. round(scale * source customers) customers are drawn; the
+    offer portfolio is kept as is. Deterministic for a given seed.
+    """
+    portfolio, events, profile = _read_source(source_dir)
+    # Salted: the sample files line up with a plain default_rng(0) stream,
+    # which made seed=0 draws biased towards customers with events
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(0x5e,)))
+
+    # 1. Draw customers and give them fresh ids
+    n_customers = int(round(len(profile) * scale))
+    picks = rng.integers(0, len(profile), size=n_customers)
+    new_ids = _random_ids(rng, n_customers)
+    synth_profile = profile.iloc[picks].copy()
+    synth_profile['id'] = new_ids
+
+    # 2. Source event rows of each customer (CSR layout: order + offsets)
+    codes = pd.Categorical(events['cliente'], categories=profile['id']).codes
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=len(profile))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    order = order[len(order) - offsets[-1]:]  # events of unknown customers sort first (code -1)
+
+    # 3. Copy each drawn customer's history
+    lengths = counts[picks]
+    starts = np.repeat(offsets[picks], lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = order[starts + within]
+    synth_events = events.iloc[rows].copy()
+    synth_events['cliente'] = np.repeat(new_ids, lengths)
+
+    # 4. The log is ordered by time, as the source export is
+    synth_events = synth_events.iloc[np.argsort(synth_events['tempo_decorrido'].to_numpy(), kind='stable')]
+
+    synth_profile.index = np.arange(1, len(synth_profile) + 1)
+    synth_events.index = np.arange(1, len(synth_events) + 1)
+    return portfolio, synth_events, synth_profile
+
+def write_dataset(out_dir, scale=1, seed=0, source_dir='data/'):
+    """Writes a generated dataset as the three source CSVs; returns out_dir.
+
+    Skips generation when the files are already there (the output only
+    depends on scale, seed and the source files).
+    """
+    paths = {name: os.path.join(out_dir, file) for name, file in FILE_NAMES.items()}
+    if all(os.path.exists(path) for path in paths.values()):
+        return out_dir
+
+    os.makedirs(out_dir, exist_ok=True)
+    portfolio, events, profile = generate_dataset(scale, seed, source_dir)
+    for name, df in (('portfolio', portfolio), ('events', events), ('profile', profile)):
+        tmp_path = paths[name] + '.tmp'
+        df.to_csv(tmp_path, encoding='latin-1')
+        os.replace(tmp_path, paths[name])
+    return out_dir
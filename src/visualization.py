@@ -1,85 +1,193 @@
-import matplotlib.pyplot as plt
+import contextlib
+import itertools
+import math
+import os
+
+import matplotlib as mpl
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
 import seaborn as sns
 import pandas as pd
 
-def plot_demographics(df, save_path=None):
-    """Plot Age and Gender distribution."""
-    sns.set(style="whitegrid")
-    fig, ax = plt.subplots(1, 2, figsize=(14, 5))
-    
-    # Get unique customers to avoid overcounting events
-    unique_customers = df[['cliente', 'idade', 'genero']].drop_duplicates()
-    
-    # Filter out age outliers (118 is used for nulls)
-    valid_customers = unique_customers[unique_customers['idade'] < 100]
-    
-    sns.histplot(valid_customers['idade'], bins=30, kde=True, ax=ax[0])
-    ax[0].set_title('Distribuição de Idade (Removido > 100)')
-    
-    sns.countplot(data=unique_customers, x='genero', ax=ax[1])
-    ax[1].set_title('Distribuição de Gênero')
-    
-    if save_path:
-        plt.savefig(f"{save_path}/demographics.png")
-    plt.show()
+from src.instrumentation import instrument
 
-def plot_funnel(df, save_path=None):
-    """Plot Offer Funnel."""
-    funnel_data = df[df['tipo_evento'].isin(['oferta visualizada', 'oferta concluída'])]
-    funnel_counts = funnel_data.groupby(['oferta', 'tipo_evento']).size().reset_index(name='contagem')
-    
-    plt.figure(figsize=(12, 6))
-    sns.barplot(data=funnel_counts, x='oferta', y='contagem', hue='tipo_evento')
-    plt.title('Funil de Oferta')
-    
+# Seaborn "whitegrid" theme as an rc dict, applied per figure instead of
+# through sns.set(), so rendering never touches global pyplot state
+THEME = {
+    **sns.axes_style('whitegrid'),
+    **sns.plotting_context('notebook'),
+    'axes.prop_cycle': mpl.cycler('color', sns.color_palette('deep')),
+}
+
+# Above this many customers plot_rfm stops drawing one marker per customer
+RFM_SCATTER_MAX_POINTS = 50_000
+
+FIGURE_FILES = {
+    'demographics': 'demographics.png',
+    'funnel': 'funnel.png',
+    'rfm': 'rfm_clusters.png',
+    'channel_performance': 'channel_performance.png',
+}
+
+@contextlib.contextmanager
+def _figure(figsize, nrows=1, ncols=1):
+    """Yields (fig, axes) for an Agg-backed Figure outside pyplot's registry."""
+    with mpl.rc_context(THEME):
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(nrows, ncols)
+        yield fig, axes
+
+def _save(fig, save_path, name, **kwargs):
     if save_path:
-        plt.savefig(f"{save_path}/funnel.png")
-    plt.show()
-
-def plot_rfm(rfm_df, save_path=None):
-    """Plot RFM Clusters."""
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(data=rfm_df, x='Recency', y='Monetary', hue='Segment', alpha=0.6)
-    plt.title('RFM Clusters')
-    plt.yscale('log')
-    plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+        fig.savefig(os.path.join(save_path, FIGURE_FILES[name]), **kwargs)
+
+@instrument
+def plot_demographics(demographics, save_path=None):
+    """Plot Age and Gender distribution.
+
+    demographics: one row per customer (see kpis.customer_demographics).
+    """
+    # Filter out age outliers (118 is used for nulls)
+    valid_customers = demographics[demographics['idade'] < 100]
     
-    if save_path:
-        plt.savefig(f"{save_path}/rfm_clusters.png", bbox_inches='tight')
-    plt.show()
-
-def plot_channel_performance(df, portfolio, save_path=None):
-    """Plot performance by channel (Reach vs Conversion)."""
-    # 1. Explode channels from portfolio
-    # (Similar to kpis.py but we need it here for merging)
-    import ast
-    port_copy = portfolio.copy()
-    # Handle string representation of list if needed, or list
-    try:
-        port_copy['canais_lista'] = port_copy['canal'].apply(lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-    except:
-        port_copy['canais_lista'] = port_copy['canal'] # Fallback
+    with _figure((14, 5), 1, 2) as (fig, ax):
+        sns.histplot(valid_customers['idade'], bins=30, kde=True, ax=ax[0])
+        ax[0].set_title('Distribuição de Idade (Removido > 100)')
         
-    offer_channels = port_copy[['id_oferta', 'canais_lista']].explode('canais_lista')
-    offer_channels = offer_channels.rename(columns={'canais_lista': 'canal_individual'})
-    
-    # 2. Filter events
-    relevant_events = df[df['tipo_evento'].isin(['oferta visualizada', 'oferta concluída', 'oferta recebida'])]
-    
-    # 3. Merge
-    # This multiplies events by number of channels the offer is available on
-    merged = relevant_events.merge(offer_channels, on='id_oferta', how='inner')
-    
-    # 4. Count
-    channel_counts = merged.groupby(['canal_individual', 'tipo_evento']).size().reset_index(name='contagem')
-    
-    # 5. Plot
-    plt.figure(figsize=(12, 6))
-    sns.barplot(data=channel_counts, x='canal_individual', y='contagem', hue='tipo_evento')
-    plt.title('Performance por Canal (Multi-atribuição)')
-    plt.ylabel('Quantidade de Eventos')
-    plt.xlabel('Canal')
-    
-    if save_path:
-        plt.savefig(f"{save_path}/channel_performance.png")
-    plt.show()
+        sns.countplot(data=demographics, x='genero', ax=ax[1])
+        ax[1].set_title('Distribuição de Gênero')
+        
+        _save(fig, save_path, 'demographics')
+    return fig
+
+@instrument
+def plot_funnel(funnel_counts, save_path=None):
+    """Plot Offer Funnel.
+
+    funnel_counts: oferta, tipo_evento, contagem (see kpis.funnel_counts).
+    """
+    with _figure((12, 6)) as (fig, ax):
+        sns.barplot(data=funnel_counts, x='oferta', y='contagem', hue='tipo_evento', ax=ax)
+        ax.set_title('Funil de Oferta')
+        
+        _save(fig, save_path, 'funnel')
+    return fig
+
+def _stratified_sample(rfm_df, max_points, min_per_segment=500, seed=0):
+    """About max_points rows, sampled per Segment in proportion to its size.
+
+    Every segment keeps at least min_per_segment rows (or all of them), so
+    small segments stay visible; row order is preserved.
+    """
+    frac = max_points / len(rfm_df)
+    rng = np.random.default_rng(seed)
+    picks = []
+    for rows in rfm_df.groupby('Segment', observed=True, sort=False).indices.values():
+        n = min(len(rows), max(min_per_segment, round(len(rows) * frac)))
+        picks.append(rng.choice(rows, n, replace=False))
+    return rfm_df.take(np.sort(np.concatenate(picks)))
+
+def _plot_rfm_density(rfm_df, save_path):
+    """One hexbin panel per segment (shared axes), cost linear in customers."""
+    # Colors follow every segment, so they do not shift when one is not drawn
+    # (the theme palette repeats past its 10 colors, for custom rule sets)
+    colors = dict(zip(rfm_df['Segment'].unique(), itertools.cycle(THEME['axes.prop_cycle'].by_key()['color'])))
+    # Monetary is drawn on a log scale, which needs positive values; a
+    # segment with none gets no panel
+    positive = rfm_df[rfm_df['Monetary'] > 0]
+    segments = list(positive['Segment'].unique())
+    if not segments:
+        with _figure((6, 4)) as (fig, ax):
+            ax.text(0.5, 0.5, 'Nenhum cliente com Monetary > 0', ha='center', va='center', transform=ax.transAxes)
+            ax.set_axis_off()
+            fig.suptitle('RFM Clusters (densidade por segmento)')
+            _save(fig, save_path, 'rfm', bbox_inches='tight')
+        return fig
+    ncols = min(3, len(segments))
+    nrows = math.ceil(len(segments) / ncols)
+    extent = (positive['Recency'].min(), positive['Recency'].max(),
+              np.log10(positive['Monetary'].min()), np.log10(positive['Monetary'].max()))
+
+    with _figure((5 * ncols, 4 * nrows), nrows, ncols) as (fig, axes):
+        axes = np.atleast_1d(axes).ravel()
+        for ax, (segment, group) in zip(axes, positive.groupby('Segment', observed=True, sort=False)):
+            ax.hexbin(group['Recency'], group['Monetary'], yscale='log', gridsize=40, extent=extent,
+                      mincnt=1, bins='log', cmap=sns.light_palette(colors[segment], as_cmap=True))
+            ax.set_title(f'{segment} ({len(group):,})')
+            ax.set_xlabel('Recency')
+            ax.set_ylabel('Monetary')
+        for ax in axes[len(segments):]:
+            ax.set_visible(False)
+        fig.suptitle('RFM Clusters (densidade por segmento)')
+        fig.tight_layout()
+
+        _save(fig, save_path, 'rfm', bbox_inches='tight')
+    return fig
+
+@instrument
+def plot_rfm(rfm_df, save_path=None, mode='auto', max_points=RFM_SCATTER_MAX_POINTS):
+    """Plot RFM Clusters.
+
+    mode: 'scatter' (one marker per customer), 'density' (hexbin per
+    segment) or 'sample' (scatter of a stratified sample of max_points
+    customers). 'auto' scatters up to max_points customers and switches to
+    density above that, so render time and PNG size stay bounded.
+    """
+    if mode == 'auto':
+        mode = 'scatter' if len(rfm_df) <= max_points else 'density'
+    if mode == 'density':
+        return _plot_rfm_density(rfm_df, save_path)
+    if mode not in ('scatter', 'sample'):
+        raise ValueError(f"Unknown RFM plot mode: {mode!r}")
+
+    title = 'RFM Clusters'
+    if mode == 'sample' and len(rfm_df) > max_points:
+        total = len(rfm_df)
+        rfm_df = _stratified_sample(rfm_df, max_points)
+        title = f'RFM Clusters (amostra estratificada: {len(rfm_df):,} de {total:,})'
+
+    with _figure((10, 6)) as (fig, ax):
+        sns.scatterplot(data=rfm_df, x='Recency', y='Monetary', hue='Segment', alpha=0.6, ax=ax)
+        ax.set_title(title)
+        ax.set_yscale('log')
+        ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+        
+        _save(fig, save_path, 'rfm', bbox_inches='tight')
+    return fig
+
+@instrument
+def plot_channel_performance(channel_counts, save_path=None):
+    """Plot performance by channel (Reach vs Conversion).
+
+    channel_counts: canal_individual, tipo_evento, contagem, where an event
+    counts once for every channel its offer is on (see kpis.channel_counts).
+    """
+    with _figure((12, 6)) as (fig, ax):
+        sns.barplot(data=channel_counts, x='canal_individual', y='contagem', hue='tipo_evento', ax=ax)
+        ax.set_title('Performance por Canal (Multi-atribuição)')
+        ax.set_ylabel('Quantidade de Eventos')
+        ax.set_xlabel('Canal')
+        
+        _save(fig, save_path, 'channel_performance')
+    return fig
+
+PLOTS = {
+    'demographics': plot_demographics,
+    'funnel': plot_funnel,
+    'rfm': plot_rfm,
+    'channel_performance': plot_channel_performance,
+}
+
+@instrument
+def render_plot(name, *args, save_dir, **options):
+    """Renders one plot to `save_dir` and frees it; returns the PNG path.
+
+    Module-level and returning only a path, so it can run in a process pool.
+    options are passed on to the plot function (e.g. plot_rfm's mode).
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    fig = PLOTS[name](*args, save_path=save_dir, **options)
+    fig.clear()
+    return os.path.join(save_dir, FIGURE_FILES[name])